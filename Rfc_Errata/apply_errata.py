@@ -1,11 +1,97 @@
 import re
 import os
+import sys
 import html
-from datetime import datetime
-from Rfc_Errata.utils import strip_pagebreaks
+import json
+import array
+import marshal
+import bisect
+import hashlib
+import functools
+from Rfc_Errata import __version__
+from Rfc_Errata.matching import SectionIndex, firstMatches, fuzzyFind, matchKey
+from Rfc_Errata.utils import strip_pagebreaks, stream_pagebreaks, file_digest, Markup, \
+    LineBuffer, LineRange, join_lines
 
 order = {"Verified": 1, "Held": 2, "Reported": 3, "Rejected": 4}
 
+# Errata texts seen by the process, shared between RFCs
+PatternCacheSize = 4096
+
+# Size of the buffer the HTML is written through
+EmitBufferSize = 64 * 1024
+
+# Approximate matching with --fuzzy: the lowest confidence accepted, the
+# shortest text worth trying and the time allowed for each errata in seconds
+FuzzyConfidence = 0.9
+FuzzyMinLength = 20
+FuzzyBudget = 0.25
+
+
+class Erratum(object):
+    """One erratum, with the fields of errata.json held in slots.
+
+    It is indexed by field name like the dict it is built from.  Fields that
+    are not known here are kept in a dict of their own, and the status and
+    document values, which repeat across thousands of errata, are interned.
+    """
+
+    Fields = ["errata_id", "doc-id", "errata_status_code", "errata_type_code", "section",
+              "orig_text", "correct_text", "notes", "submit_date", "submitter_name",
+              "verifier_id", "verifier_name", "update_date", "title", "pub-date", "format",
+              "status_tag", "section2", "orig_text2", "correct_text2"]
+    Slots = dict((field, field.replace("-", "_")) for field in Fields)
+    Interned = {"doc-id", "errata_status_code", "errata_type_code", "status_tag", "format"}
+
+    __slots__ = [field.replace("-", "_") for field in Fields] + ["extra"]
+
+    def __init__(self, fields=None):
+        self.extra = None
+        if fields:
+            for k in fields:
+                self[k] = fields[k]
+
+    def __getitem__(self, k):
+        try:
+            if k in self.Slots:
+                return getattr(self, self.Slots[k])
+            if self.extra is not None:
+                return self.extra[k]
+        except AttributeError:
+            pass
+        raise KeyError(k)
+
+    def __setitem__(self, k, value):
+        if k in self.Interned and isinstance(value, str):
+            value = sys.intern(value)
+        if k in self.Slots:
+            setattr(self, self.Slots[k], value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[k] = value
+
+    def __contains__(self, k):
+        if k in self.Slots:
+            return hasattr(self, self.Slots[k])
+        return self.extra is not None and k in self.extra
+
+    def __iter__(self):
+        for field in self.Fields:
+            if hasattr(self, self.Slots[field]):
+                yield field
+        if self.extra is not None:
+            yield from self.extra
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def asDict(self):
+        return dict((k, self[k]) for k in self)
+
 
 def inlineSectionKey(data):
     return "{0}||{2}||{1}".format(data["section2"], data["errata_id"], order[data["status_tag"]])
@@ -20,6 +106,10 @@ def sortById(data):
     return "{0:6}".format(data["errata_id"])
 
 
+def sortByNumber(data):
+    return int(data["errata_id"])
+
+
 def increment(tag):
     if tag[0].isdigit():
         return str(int(tag)+1)
@@ -32,7 +122,138 @@ def increment(tag):
     return tag[:i] + str(int(tag[i:])+1)
 
 
-startTime = datetime(1970, 1, 1)
+@functools.lru_cache(maxsize=PatternCacheSize)
+def compilePattern(string):
+    #  \u200C   ---- 3312 - RFC 5892  --- zero width non-joiner
+    #  \u2019   ---- 5178 - RFC 6218  --- right single quotation mark
+    #  \u2026   ---- 1117 - RFC 4601  --- ... - ellipsis
+    #  \u2014   ---- 4483 - RFC 5952  --- emdash
+
+    # string = string.replace("\u2018", "'").replace("\u201B", "'"). \
+    #          replace('\u2019', "'").replace('\u201C', "'"). \
+    #          replace("\u201C", '"').replace('\u201D', '"')
+
+    for ch in ['\\', '`', '*', '+', '?', '(', ')', '=', '[', ']', '.', '{', '}', '~', '$', '^', '|']:
+        if ch in string:
+            string = string.replace(ch, "\\"+ch)
+
+    string = string.strip()
+    string = re.sub(r"\s+", r"\\s+", string)
+    return re.compile(string)
+
+
+@functools.lru_cache(maxsize=PatternCacheSize)
+def errataKey(string):
+    return matchKey(string)
+
+
+@functools.lru_cache(maxsize=PatternCacheSize)
+def normaliseErrata(origText, correctText):
+    "Strip page breaks, change bars and ellipses from the errata texts"
+    oldTextIn = origText
+    if "..." in oldTextIn:
+        m = re.match("\s*\[?\.\.\.\]?", oldTextIn)
+        if m:
+            oldTextIn = oldTextIn[m.end():]
+        m = re.search("\[?\.\.\.\]?\s*$", oldTextIn)
+        if m:
+            oldTextIn = oldTextIn[:m.start()]
+
+    lines, a = strip_pagebreaks(oldTextIn)
+    if len(lines) == 0:
+        return None
+
+    newLines = []
+
+    for line in lines:
+        line = line.txt
+        if len(line) > 0 and line[0] == '|':
+            line = line[1:]
+        match = re.match("[\s\^v]+$", line)
+        if match:
+            line = None
+        else:
+            newLines.append(line)
+
+    oldText = "\n".join(newLines)
+
+    newText = correctText
+    if newText:
+        lines, a = strip_pagebreaks(newText)
+        newLines = []
+        for line in lines:
+            line = line.txt
+            if len(line) > 0 and line[0] == '|':
+                line = line[1:]
+            match = re.match("[\s\^v]+$", line)
+            if match:
+                line = None
+            else:
+                newLines.append(line)
+
+        newText = "\n".join(newLines)
+
+    if oldText == oldTextIn:
+        return None
+
+    if newText and "..." in newText:
+        m = re.match("\s*\[?\.\.\.\]?", newText)
+        if m:
+            newText = newText[m.end():]
+        m = re.search("\[?\.\.\.\]?\s*$", newText)
+        if m:
+            newText = newText[:m.start()]
+
+    return oldText, newText
+
+
+def overlapsEdit(layer, start, end):
+    "Does start..end overlap one of the edits of layer?"
+    text, starts, edits = layer
+    i = bisect.bisect_left(starts, start)
+    if i > 0 and edits[i-1][2] > start:
+        return True
+    if i < len(edits) and edits[i][1] < end:
+        return True
+    return False
+
+
+def findEdit(layer, pattern, span=None):
+    """Find the first place pattern can be applied in layer.
+
+    This is the first occurrence that is clear of the edits already made,
+    either in the text of the layer or in the text of an earlier edit.
+    span is the first occurrence in the text of the layer when it is known.
+    Returns (layer, start, end) or None.
+    """
+    if span is None:
+        match = pattern.search(layer[0])
+        span = match.span() if match else None
+    while span and overlapsEdit(layer, span[0], span[1]):
+        match = pattern.search(layer[0], span[0] + 1)
+        span = match.span() if match else None
+
+    for edit in layer[2]:
+        if span and edit[1] >= span[0]:
+            break
+        found = findEdit(edit[4], pattern)
+        if found:
+            return found
+
+    if span:
+        return layer, span[0], span[1]
+    return None
+
+
+def renderEnvironment(templates, options, state):
+    # Everything other than the RFC text and its errata that ends up in the output
+
+    digest = hashlib.sha256()
+    for value in [__version__, templates.digest, state["ossPath"], str(options.search),
+                  str(getattr(options, "fuzzy", False))]:
+        digest.update(value.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
 
 
 class apply_errata(object):
@@ -51,14 +272,18 @@ class apply_errata(object):
         self.InlineCount = 0
         self.SectionCount = 0
         self.EndnoteCount = 0
-        self.toApply = toBeApplied
-        self.title = toBeApplied[0]["doc-id"]
+        self.anchors = {}
+        self.escapedFields = {}
+        self.toApply = [item if isinstance(item, Erratum) else Erratum(item) for item in toBeApplied]
+        self.title = self.toApply[0]["doc-id"]
         self.options = options
+        self.fuzzy = getattr(options, "fuzzy", False)
         self.state = state
 
         # Strings used in the process
 
-        self.inlineFormat = "<span class=\"{0}-inline-styling\" id='inline-{1}'>{2}</span id__locate={1}>"
+        self.inlineOpen = "<span class=\"{0}-inline-styling\" id='inline-{1}'>"
+        self.inlineClose = "</span id__locate={0}>"
         self.inlineExpandWrapper = "<div class=\"nodeCloseClass\" id='expand_{0}'>{1}</div>"
         self.buttonFormat = " <button id=\"btn_{0}\" target=\"expand_{0}\" onclick='hideFunction(\"expand_{0}\")'>Expand</button>\n"
 
@@ -69,69 +294,71 @@ class apply_errata(object):
 
         self.templates = templates
 
-        if not force and os.path.exists(htmlFile):
-            statIfno = os.stat(htmlFile)
+        # The key covers everything that the output depends on, so an
+        # unchanged key means that the existing file is still correct.
 
-            update = False
-            for item in self.toApply:
-                updateTime = item["update_date"]
-                if not updateTime:
-                    updateTime = item["submit_date"]
-                    if not updateTime:
-                        continue
-                    else:
-                        itemUpdate = datetime.strptime(updateTime, "%Y-%m-%d")
-                else:
-                    itemUpdate = datetime.strptime(updateTime, "%Y-%m-%d %H:%M:%S")
+        keyFile = os.path.join(self.state["html"], self.RfcName + ".key")
+        textDigest = file_digest(fileName)
+        renderKey = self.renderKey(textDigest)
+        if not force and os.path.exists(htmlFile) and os.path.exists(keyFile):
+            with open(keyFile) as f:
+                if f.read() == renderKey:
+                    return
 
-                itemUpdate = (itemUpdate - startTime).total_seconds()
-                if itemUpdate > statIfno.st_mtime:
-                    update = True
-                    break
+        # The header lists every errata, including the ones placed below
 
-            if not update:
-                return
+        self.allErrata = list(self.toApply)
+        for item in self.allErrata:
+            item["errata_id"] = str(item["errata_id"])
 
         #  Open the source file and read in.
 
-        self.buildHeader()
+        if not self.loadPreprocessed(textDigest):
+            self.loadDocument(fileName)
 
-        self.loadDocument(fileName)
+            self.sectionDocument()
 
-        self.sectionDocument()
+            self.savePreprocessed(textDigest)
 
         self.createInlineNotes()
 
         self.createSectionNotes()
 
-        self.unsectionDocument()
+        self.buildHeader()
+
         self.createFootnotes()
         self.emitHtml()
 
-    def loadDocument(self, fileName):
-        try:
-            with open(fileName, "r", encoding='utf-8') as f:
-                text = f.read()
-        except UnicodeDecodeError:
-            with open(fileName, "r", encoding='iso-8859-1') as f:
-                text = f.read()
+        with open(keyFile, "w") as f:
+            f.write(renderKey)
+
+    def renderKey(self, textDigest):
+        digest = hashlib.sha256()
+        digest.update(textDigest.encode('utf-8'))
+        digest.update(json.dumps([item.asDict() for item in self.toApply], sort_keys=True).encode('utf-8'))
+        digest.update(renderEnvironment(self.templates, self.options, self.state).encode('utf-8'))
+        return digest.hexdigest()
 
+    def loadDocument(self, fileName):
         # Do the the first set of simple changes
         # 1.  Strip page headers/footer and page-feed
         # 2.  ?????
 
-        # Import the method from id2xml
-
-        a, shortTitle = strip_pagebreaks(text)
+        # Pages are read and stripped one at a time.  The lines are kept as
+        # one string with their offsets once the indent is removed.
 
-        self.source = [x.txt for x in a]
-        self.source = "\n".join(self.source).splitlines(True)
+        try:
+            with open(fileName, "r", encoding='utf-8') as f:
+                lines = list(stream_pagebreaks(f))
+        except UnicodeDecodeError:
+            with open(fileName, "r", encoding='iso-8859-1') as f:
+                lines = list(stream_pagebreaks(f))
 
         # Figure out what the indent level is
 
         indent = 72
         pattern = re.compile("^( *)")
-        for line in self.source:
+        for line in lines:
             if len(line) == 1:
                 continue
             match = pattern.match(line)
@@ -143,25 +370,66 @@ class apply_errata(object):
                         break
 
         if indent > 0:
-            newSource = []
-            for line in self.source:
+            for i, line in enumerate(lines):
                 if len(line) > 1:
-                    newSource.append(line[indent:])
-                else:
-                    newSource.append(line)
+                    lines[i] = line[indent:]
+
+        self.source = LineBuffer(lines)
+
+    # --- Cache of stripped and sectioned documents ---------------------
+
+    def preprocessedFile(self):
+        if "cache" not in self.state:
+            return None
+        return os.path.join(self.state["cache"], self.RfcName + ".pre")
+
+    def preprocessedKey(self, textDigest):
+        # marshal output is only readable by the same Python version
+        return "{0}:{1}:{2}".format(__version__, ".".join(str(v) for v in sys.version_info[:2]), textDigest)
+
+    def loadPreprocessed(self, textDigest):
+        # RFC texts never change once published, so the stripped lines and the
+        # section boundaries can be reused for as long as the text hash matches.
+
+        fileName = self.preprocessedFile()
+        if fileName is None or not os.path.exists(fileName):
+            return False
+
+        try:
+            with open(fileName, "rb") as f:
+                key, text, offsets, allSections, ranges = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return False
+        if key != self.preprocessedKey(textDigest):
+            return False
+
+        self.source = LineBuffer(text=text, offsets=array.array('L', offsets))
+        self.allSections = allSections
+        self.sectionRanges = ranges
+        self.sectionDict = dict((section, LineRange(self.source, start, end))
+                                for section, (start, end) in ranges.items())
+        return True
+
+    def savePreprocessed(self, textDigest):
+        fileName = self.preprocessedFile()
+        if fileName is None:
+            return
 
-            self.source = newSource
+        data = (self.preprocessedKey(textDigest), self.source.text, self.source.offsets.tobytes(),
+                self.allSections, self.sectionRanges)
+        with open(fileName + ".tmp", "wb") as f:
+            marshal.dump(data, f)
+        os.replace(fileName + ".tmp", fileName)
 
     def addToKnowns(self, section):
-        section = section.lower()
-        if section not in self.knownSections:
-            self.knownSections.append(section)
+        self.knownSections.add(section.lower())
 
     def isSectionStart(self, line, i):
-        if line.strip().lower() in self.knownSections:
-            if line.strip().lower() == "table of contents":
-                return line.strip().lower(), False
-            return line.strip().lower(), True
+        title = line.strip().lower()
+        if title in self.knownSections:
+            if title == "table of contents":
+                return title, False
+            return title, True
 
         header = self.header_re.match(line)
         if not header:
@@ -178,7 +446,7 @@ class apply_errata(object):
             potentialSection = potentialSection[:-2]
 
         if "..." in line or ". ." in line:
-            self.tocSections.append(potentialSection)
+            self.tocSections.add(potentialSection)
             return None, False
 
         if potentialSection not in self.knownSections:
@@ -202,8 +470,7 @@ class apply_errata(object):
         elif lpad > 0:
             return None, True
 
-        if potentialSection in self.knownSections:
-            self.knownSections.remove(potentialSection)
+        self.knownSections.discard(potentialSection)
 
         # Remove items from the known set
         # For X.Y
@@ -250,17 +517,22 @@ class apply_errata(object):
         self.sectionIndent = None
         self.centeredTitle = None
 
-        self.knownSections = ["status of this memo", "copyright notice", "abstract",
+        self.knownSections = {"status of this memo", "copyright notice", "abstract",
                               "table of contents",
                               "1", "appendix a", "appendix i", "appendix 1",
                               "acknowledgements", "acknowledgments", "authors' addresses",
                               "author's address",
-                              "full copyright statement", "security considerations"]
+                              "full copyright statement", "security considerations"}
         self.currentSection = "Header"
         self.startLine = 0
         self.allSections = []
+
+        # Each section starts out as a LineRange over the source.  Sections
+        # that get errata placed in them are replaced by a list of their lines.
+
         self.sectionDict = {}
-        self.tocSections = []
+        self.sectionRanges = {}
+        self.tocSections = set()
 
         i = 0
         while i < len(self.source):
@@ -273,7 +545,8 @@ class apply_errata(object):
                 self.currentSection = self.currentSection.lower().rstrip()
                 self.currentSection = html.unescape(self.currentSection)
                 self.allSections.append(self.currentSection)
-                self.sectionDict[self.currentSection] = self.source[self.startLine:i]
+                self.sectionDict[self.currentSection] = LineRange(self.source, self.startLine, i)
+                self.sectionRanges[self.currentSection] = (self.startLine, i)
                 self.currentSection = isStart
                 self.startLine = i
 
@@ -286,7 +559,8 @@ class apply_errata(object):
         self.currentSection = self.currentSection.lower().rstrip()
         self.currentSection = html.unescape(self.currentSection)
         self.allSections.append(self.currentSection)
-        self.sectionDict[self.currentSection] = self.source[self.startLine:i]
+        self.sectionDict[self.currentSection] = LineRange(self.source, self.startLine, i)
+        self.sectionRanges[self.currentSection] = (self.startLine, i)
 
     def unsectionDocument(self):
         sections = []
@@ -295,83 +569,15 @@ class apply_errata(object):
         self.source = sections
 
     def buildPattern(self, string):
-        #  \u200C   ---- 3312 - RFC 5892  --- zero width non-joiner
-        #  \u2019   ---- 5178 - RFC 6218  --- right single quotation mark
-        #  \u2026   ---- 1117 - RFC 4601  --- ... - ellipsis
-        #  \u2014   ---- 4483 - RFC 5952  --- emdash
-
-        # string = string.replace("\u2018", "'").replace("\u201B", "'"). \
-        #          replace('\u2019', "'").replace('\u201C', "'"). \
-        #          replace("\u201C", '"').replace('\u201D', '"')
-
-        string = html.escape(string)
-
-        for ch in ['\\', '`', '*', '+', '?', '(', ')', '=', '[', ']', '.', '{', '}', '~', '$', '^', '|']:
-            if ch in string:
-                string = string.replace(ch, "\\"+ch)
-
-        string = string.strip()
-        string = re.sub(r"\s+", r"\\s+", string)
-        return re.compile(string)
+        return compilePattern(errataKey(string))
 
     def buildPattern2(self, item):
-        oldTextIn = item["orig_text"]
-        if "..." in oldTextIn:
-            m = re.match("\s*\[?\.\.\.\]?", oldTextIn)
-            if m:
-                oldTextIn = oldTextIn[m.end():]
-            m = re.search("\[?\.\.\.\]?\s*$", oldTextIn)
-            if m:
-                oldTextIn = oldTextIn[:m.start()]
-
-        lines, a = strip_pagebreaks(oldTextIn)
-        if len(lines) == 0:
+        texts = normaliseErrata(item["orig_text"], item["correct_text"])
+        if texts is None:
             return None
 
-        newLines = []
-
-        for line in lines:
-            line = line.txt
-            if len(line) > 0 and line[0] == '|':
-                line = line[1:]
-            match = re.match("[\s\^v]+$", line)
-            if match:
-                line = None
-            else:
-                newLines.append(line)
-
-        oldText = "\n".join(newLines)
-
-        newText = item["correct_text"]
-        if newText:
-            lines, a = strip_pagebreaks(newText)
-            newLines = []
-            for line in lines:
-                line = line.txt
-                if len(line) > 0 and line[0] == '|':
-                    line = line[1:]
-                match = re.match("[\s\^v]+$", line)
-                if match:
-                    line = None
-                else:
-                    newLines.append(line)
-
-            newText = "\n".join(newLines)
-
-        if oldText == oldTextIn:
-            return None
-
-        if newText and "..." in newText:
-            m = re.match("\s*\[?\.\.\.\]?", newText)
-            if m:
-                newText = newText[m.end():]
-            m = re.search("\[?\.\.\.\]?\s*$", newText)
-            if m:
-                newText = newText[:m.start()]
-
-        item["orig_text2"] = oldText
-        item["correct_text2"] = newText
-        return self.buildPattern(oldText)
+        item["orig_text2"], item["correct_text2"] = texts
+        return self.buildPattern(texts[0])
 
     def buildInlines(self, section, itemList, searchText):
 
@@ -381,103 +587,152 @@ class apply_errata(object):
         if len(itemList) == 0:
             return
 
-        editedText = searchText
-        locations = []
+        # Each edit replaces a span of the text of its layer with the errata
+        # text, which is a layer of its own that later errata can edit in turn.
+        # An edit is [itemList entry, start, end, notes, layer] and a layer is
+        # [text, edit starts, edits] with the edits sorted and disjoint.
 
+        document = [searchText, [], []]
+        located = []
         for item in itemList:
-            match = re.search(item[2], editedText)
-            # print("pattern = {0}".format(item[2]))
-            if match:
-                if "orig_text2" in item[0]:
-                    newText = item[0]["orig_text2"] if item[0]["status_tag"] == "Rejected" else item[0]["correct_text2"]
-                else:
-                    newText = item[0]["orig_text"] if item[0]["status_tag"] == "Rejected" else item[0]["correct_text"]
-                if not newText:
-                    newText = ""
-                newText = html.escape(newText)
-                editedText = editedText[:match.start()] +  \
-                    self.inlineFormat.format(item[0]["status_tag"], item[0]["errata_id"], newText) + \
-                    editedText[match.end():]
-                locations.append([item, item[1].start(), item[1].end(), False])
+            found = findEdit(document, item[2], item[1])
+            if found is None:
+                continue
+
+            layer, start, end = found
+            if "orig_text2" in item[0]:
+                newText = item[0]["orig_text2"] if item[0]["status_tag"] == "Rejected" else item[0]["correct_text2"]
+            else:
+                newText = item[0]["orig_text"] if item[0]["status_tag"] == "Rejected" else item[0]["correct_text"]
+            if not newText:
+                newText = ""
 
-        sectionLines = editedText.splitlines(True)
+            edit = [item, start, end, [item[0]], [newText, [], []]]
+            i = bisect.bisect_left(layer[1], start)
+            layer[1].insert(i, start)
+            layer[2].insert(i, edit)
+            located.append(edit)
 
-        for item in itemList:
-            for loc in locations:
-                if item == loc[0]:
-                    item[3] = True
-                    endTag = re.compile("id__locate={0}".format(item[0]["errata_id"]))
-                    startTag = re.compile("inline-{0}".format(item[0]["errata_id"]))
-                    self.header = self.header.replace("#eid{0}".format(item[0]["errata_id"]),
-                                                      "#btn_{0}".format(item[0]["errata_id"]))
-                    for line in range(len(sectionLines)):
-                        m = startTag.search(sectionLines[line])
-                        if m:
-                            sectionLines[line] = sectionLines[line][:-1] + self.buttonFormat.format(item[0]["errata_id"])
-                        m = endTag.search(sectionLines[line])
-                        if m:
-                            sectionLines.insert(line+1, self.inlineExpandWrapper.format(item[0]["errata_id"],
-                                                                                        self.substitute(self.templates.inlineNote, item[0])))
-                            break
+            item[3] = True
+            self.anchors.setdefault(item[0]["errata_id"], "btn_{0}".format(item[0]["errata_id"]))
+
+        # The notes of the errata whose text was taken by an edit go into the
+        # expand block of that edit
 
-        button = re.compile("Expand</button")
         for item in itemList:
             if item[3]:
                 continue
-            for locate in locations:
-                if locate[1] > item[1].end() or locate[2] < item[1].start():
+            for locate in document[2]:
+                if locate[1] > item[1][1] or locate[2] < item[1][0]:
                     continue
-                expandTag = re.compile("id='expand_{0}".format(locate[0][0]["errata_id"]))
-                self.header = self.header.replace("#eid{0}".format(item[0]["errata_id"]),
-                                                  "#btn_{0}".format(locate[0][0]["errata_id"]))
-                for line in range(len(sectionLines)):
-                    m = expandTag.search(sectionLines[line])
-                    if m:
-                        if sectionLines[line][-6:] != "</div>":
-                            print("Internal Error")
-                            break
-                        sectionLines[line] = sectionLines[line][:-6] + \
-                            self.substitute(self.templates.inlineNote, item[0]) + "</div>"
-                        break
-                    m = button.search(sectionLines[line])
-                    if m:
-                        sectionLines[line] = sectionLines[line][:m.start()] + \
-                                                "Expand Multiple</button" + \
-                                                sectionLines[line][m.end():]
+                self.anchors.setdefault(item[0]["errata_id"], "btn_{0}".format(locate[0][0]["errata_id"]))
+                locate[3].append(item[0])
+
+        # Splice the edits in, then put the buttons on the line each edit
+        # starts on and the expand blocks after the line it ends on
+
+        pieces = []
+        spans = {}
+        self.spliceLayer(document, pieces, 0, spans)
+
+        sectionLines = [Markup(line) for line in "".join(pieces).splitlines(True)]
+        lineStarts = []
+        length = 0
+        for line in sectionLines:
+            lineStarts.append(length)
+            length += len(line)
+
+        buttons = {}
+        wrappers = {}
+        for edit in located:
+            start, end = spans[id(edit)]
+            errataId = edit[0][0]["errata_id"]
+
+            button = self.buttonFormat.format(errataId)
+            if len(edit[3]) > 1:
+                button = button.replace("Expand</button", "Expand Multiple</button")
+            buttons.setdefault(bisect.bisect_right(lineStarts, start) - 1, []).append(button)
+
+            notes = "".join(self.substitute(self.templates.inlineNote, note) for note in edit[3])
+            wrappers.setdefault(bisect.bisect_right(lineStarts, end) - 1, []).insert(
+                0, Markup(self.inlineExpandWrapper.format(errataId, notes)))
+
+        for line in buttons:
+            for button in buttons[line]:
+                sectionLines[line] = Markup(sectionLines[line][:-1] + button)
+
+        for line in sorted(wrappers, reverse=True):
+            sectionLines[line+1:line+1] = wrappers[line]
 
         # print("**result:\n{0}**".format("".join(sectionLines)))
         self.sectionDict[section] = sectionLines
 
+    def spliceLayer(self, layer, pieces, length, spans):
+        # Append the text of layer with its edits to pieces, noting where the
+        # markup of each edit starts and ends.  Returns the new total length.
+
+        text, starts, edits = layer
+        last = 0
+        for edit in edits:
+            item = edit[0][0]
+            pieces.append(html.escape(text[last:edit[1]]))
+            length += len(pieces[-1])
+            start = length
+
+            pieces.append(self.inlineOpen.format(item["status_tag"], item["errata_id"]))
+            length += len(pieces[-1])
+            length = self.spliceLayer(edit[4], pieces, length, spans)
+            pieces.append(self.inlineClose.format(item["errata_id"]))
+            length += len(pieces[-1])
+
+            spans[id(edit)] = (start, length - 1)
+            last = edit[2]
+
+        pieces.append(html.escape(text[last:]))
+        return length + len(pieces[-1])
+
     def createInlineNotes(self):
 
+        # Matching is done on the plain text, which is escaped as it is
+        # written out or as the edits are spliced in
+
         combinedLines = {}
         combinedLine = ""
         for section in self.sectionDict:
-            combinedLines[section] = html.escape("".join(self.sectionDict[section]))
-            self.sectionDict[section] = combinedLines[section].splitlines(True)
+            combinedLines[section] = join_lines(self.sectionDict[section])
 
         if self.options.search:
+            index = None
             for item in self.toApply:
                 section = item["section2"]
-                if section in self.allSections:
+                if section in self.sectionDict:
                     continue
                 if section[:9] == "appendix ":
                     test = section[9:]
-                    if test in self.allSections:
+                    if test in self.sectionDict:
                         item["section2"] = test
                         continue
                 if len(section) > 0 and section[0].isalpha():
                     test = "appendix " + section
-                    if test in self.allSections:
+                    if test in self.sectionDict:
                         item["section2"] = test
                         continue
 
                 if not item["orig_text"]:
                     continue
 
+                # Only the sections holding the inner words of the text can match
+
+                if index is None:
+                    index = SectionIndex(combinedLines)
+
                 pattern = self.buildPattern(item["orig_text"])
                 pattern2 = self.buildPattern2(item)
-                for section in self.sectionDict:
+                candidates = index.lookup(item["orig_text"])
+                if pattern2:
+                    candidates |= index.lookup(item["orig_text2"])
+
+                for section in index.sections(candidates):
                     match = pattern.search(combinedLines[section])
                     if match:
                         item["section2"] = section
@@ -491,18 +746,37 @@ class apply_errata(object):
 
         ids = sorted(self.toApply, key=inlineSectionKey)
 
+        # Find the first occurrence of every distinct errata text in its
+        # section, then retry the ones that were not found with the page
+        # breaks and change bars removed
+
+        wanted = {}
+        for item in ids:
+            if item["orig_text"] and item["section2"] in self.sectionDict:
+                wanted.setdefault(item["section2"], set()).add(errataKey(item["orig_text"]))
+        found = firstMatches(combinedLines, wanted, compilePattern)
+
+        wanted = {}
+        for item in ids:
+            if item["orig_text"] and item["section2"] in self.sectionDict:
+                if (item["section2"], errataKey(item["orig_text"])) in found:
+                    continue
+                texts = normaliseErrata(item["orig_text"], item["correct_text"])
+                if texts is not None:
+                    wanted.setdefault(item["section2"], set()).add(errataKey(texts[0]))
+        found2 = firstMatches(combinedLines, wanted, compilePattern)
+
         putInline = []
+        placed = set()
         lastSection = ids[0]["section2"]
 
-        for id in ids:
-            item = id
-
+        for item in ids:
             # nothing to be matched
             if not item["orig_text"]:
                 continue
 
             section = item["section2"]
-            if section not in self.allSections:
+            if section not in self.sectionDict:
                 continue
 
             if section != lastSection:
@@ -511,56 +785,73 @@ class apply_errata(object):
                 putInline = []
 
             combinedLine = combinedLines[section]
-            pattern = self.buildPattern(item["orig_text"])
 
-            match = pattern.search(combinedLine)
-            if match:
-                # print("*** FOUND PATTERN - section {0}".format(section))
-                # print(pattern)
-                self.toApply.remove(item)
+            span = found.get((section, errataKey(item["orig_text"])))
+            if span:
+                placed.add(id(item))
                 self.InlineCount += 1
-                putInline.append([item, match, pattern, False])
+                putInline.append([item, span, self.buildPattern(item["orig_text"]), False])
             else:
                 pattern2 = self.buildPattern2(item)
-                if pattern2 is None:
-                    continue
-                match = pattern2.search(combinedLine)
-                if match:
-                    self.toApply.remove(item)
+                if pattern2 is not None:
+                    span = found2.get((section, errataKey(item["orig_text2"])))
+                if span:
+                    placed.add(id(item))
                     self.InlineCount += 1
-                    putInline.append([item, match, pattern2, False])
-                else:
-                    # print("*** FAILED PATTERN - section {0}".format(section))
-                    # print(pattern)
-                    # print(item["orig_text"])
-                    pass
+                    putInline.append([item, span, pattern2, False])
+                elif self.fuzzy:
+                    located = self.fuzzyLocate(item, combinedLine)
+                    if located:
+                        placed.add(id(item))
+                        self.InlineCount += 1
+                        putInline.append([item, located[0], located[1], False])
 
         self.buildInlines(lastSection, putInline, combinedLine)
+        self.toApply = [item for item in self.toApply if id(item) not in placed]
+
+    def fuzzyLocate(self, item, text):
+        # The text the submitter quoted can differ slightly from the RFC, so
+        # as a last resort look for the closest approximate match in the section
+
+        oldText = item.get("orig_text2", item["orig_text"])
+        if len(oldText.strip()) < FuzzyMinLength:
+            return None
+
+        found = fuzzyFind(oldText, text, FuzzyConfidence, FuzzyBudget)
+        if found is None:
+            return None
+
+        start, end, confidence = found
+        if getattr(self.options, "verbose", False):
+            print("{0}: errata {1} placed by approximate match in section {2}, confidence {3:.2f}".format(
+                self.RfcName, item["errata_id"], item["section2"], confidence))
+        return (start, end), self.buildPattern(text[start:end])
 
     def createSectionNotes(self):
         # M00BUG title continutations
 
-        ids = sorted([item["errata_id"] for item in self.toApply], reverse=True)
-        byId = dict((item["errata_id"], item) for item in self.toApply)
+        # The notes of a section go in below its title in order of errata id
 
-        for id in ids:
-            item = byId[id]
-            if not item["section2"] in self.allSections:
+        notes = {}
+        placed = set()
+        for item in sorted(self.toApply, key=lambda item: item["errata_id"]):
+            if not item["section2"] in self.sectionDict:
                 continue
 
             if False:
                 x = item["orig_text"].splitlines()
                 print("{0}: {1}\n    {2}\n".format(item["errata_id"], x[0], x[1]))
 
-            text = self.substitute(self.templates.sectionNote, item)
-
-            section = self.sectionDict[item["section2"]]
-            section = section[:2] + [text] + section[2:]
-            self.sectionDict[item["section2"]] = section
-            self.toApply.remove(item)
+            notes.setdefault(item["section2"], []).append(Markup(self.substitute(self.templates.sectionNote, item)))
+            placed.add(id(item))
 
             self.SectionCount += 1
 
+        for name in notes:
+            section = self.sectionDict[name]
+            self.sectionDict[name] = section[:2] + notes[name] + section[2:]
+        self.toApply = [item for item in self.toApply if id(item) not in placed]
+
     def createFootnotes(self):
         errataFooter = ""
 
@@ -578,19 +869,19 @@ class apply_errata(object):
         self.errataFooter = errataFooter
 
     def buildHeader(self):
-        anchorTemplate = " <a href='#eid{0}'>EID {0}</a>, "
+        anchorTemplate = " <a href='#{1}'>EID {0}</a>, "
 
-        ids = sorted(self.toApply, key=sortById)
+        ids = sorted(self.allErrata, key=sortByNumber)
 
         errataHeader = {}
         for item in ids:
             code = item["status_tag"]
-            item["errata_id"] = str(item["errata_id"])
 
             if code not in errataHeader:
                 errataHeader[code] = {"status_tag": code, "errata_list": ""}
 
-            errataHeader[code]["errata_list"] += anchorTemplate.format(item["errata_id"])
+            anchor = self.anchors.get(item["errata_id"], "eid{0}".format(item["errata_id"]))
+            errataHeader[code]["errata_list"] += anchorTemplate.format(item["errata_id"], anchor)
 
         header = ""
         for keys in ["Verified", "Held", "Reported", "Rejected"]:
@@ -599,27 +890,48 @@ class apply_errata(object):
                 header += self.templates.headNote.substitute(errataHeader[keys])
         self.header = header
 
+    def escapeFields(self, fields):
+        # The escaped fields of an errata are the same for every template it
+        # is rendered with, so they are worked out once
+
+        escaped = self.escapedFields.get(fields["errata_id"])
+        if escaped is None:
+            escaped = {}
+            for k in fields:
+                if isinstance(fields[k], str):
+                    lines = fields[k].splitlines()
+                    lines = [html.escape(line) for line in lines]
+                    escaped[k] = '\n'.join(lines)
+                else:
+                    escaped[k] = fields[k]
+            self.escapedFields[fields["errata_id"]] = escaped
+        return escaped
+
     def substitute(self, template, fields):
-        fields2 = {}
-        for k in fields:
-            if isinstance(fields[k], str):
-                lines = fields[k].splitlines()
-                lines = [html.escape(line) for line in lines]
-                fields2[k] = '\n'.join(lines)
-                if k == "notes":
-                    fields2["notes"] = fields2["notes"].replace("\n", "<br/>")
-            else:
-                fields2[k] = fields[k]
+        fields2 = self.escapeFields(fields)
+        if isinstance(fields.get("notes"), str):
+            return template.substitute(fields2, notes=fields2["notes"].replace("\n", "<br/>"))
         return template.substitute(fields2)
 
+    def bodyLines(self):
+        # The document a line at a time, straight from the sections
+        for header in self.allSections:
+            lines = self.sectionDict[header]
+            if isinstance(lines, LineRange):
+                yield html.escape(lines.join())
+                continue
+            for line in lines:
+                yield line if isinstance(line, Markup) else html.escape(line)
+
     def emitHtml(self):
 
         fields = {}
         fields["HEADER"] = self.header
         fields["PATH"] = self.state["ossPath"]
-        fields["BODY"] = "".join(self.source)
+        fields["BODY"] = self.bodyLines()
         fields["FOOTER"] = self.errataFooter
         fields["TITLE"] = self.title
 
-        with open(os.path.join(self.state["html"], self.RfcName + ".html"), "w", encoding='utf-8') as f:
-            f.write(self.templates.html.substitute(fields))
+        with open(os.path.join(self.state["html"], self.RfcName + ".html"), "w", encoding='utf-8',
+                  buffering=EmitBufferSize) as f:
+            self.templates.html.write(f, fields)
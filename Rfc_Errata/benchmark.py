@@ -0,0 +1,239 @@
+import gc
+import glob
+import json
+import os
+import random
+import re
+import sys
+import timeit
+import optparse
+import tracemalloc
+
+from Rfc_Errata.utils import strip_pagebreaks, Line
+from Rfc_Errata.apply_errata import Erratum, compilePattern
+from Rfc_Errata.matching import firstMatches, matchKey
+
+testDir = os.path.join(os.path.dirname(__file__), "Tests")
+
+
+def loadTexts():
+    texts = {}
+    for fileName in sorted(glob.glob(os.path.join(testDir, "RFC*.txt"))):
+        try:
+            with open(fileName, "r", encoding='utf-8') as f:
+                texts[os.path.basename(fileName)] = f.read()
+        except UnicodeDecodeError:
+            with open(fileName, "r", encoding='iso-8859-1') as f:
+                texts[os.path.basename(fileName)] = f.read()
+    return texts
+
+
+def referenceStrip(text):
+    # strip_pagebreaks as it was before its patterns were compiled once: each
+    # heuristic is a pattern string handed to re.search for every line.  Kept
+    # only to time against, for texts with form feeds.
+
+    short_title = None
+    stripped = []
+    newpage = False
+
+    lastLine = 0
+    for page in text.split('\f'):
+        firstLine = lastLine
+        lines = []
+
+        for lineno, line in enumerate(page.splitlines()):
+            lines += [Line(lineno + firstLine, line.rstrip())]
+        lines += [Line(len(lines)+firstLine, "")]
+
+        lastLine = firstLine + len(lines)
+
+        for i in range(len(lines)):
+            line = lines[i].txt
+
+            if len(line) == 0:
+                continue
+
+            if firstLine > 0:
+                regex = r"^(INTERNET.DRAFT|Internet.Draft|RFC \d+)(  +)(\S.*\S)(  +)(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]*( \d\d?,)? (19[89][0-9]|20[0-9][0-9]) *$"
+                match = re.search(regex, line, re.I)
+                if match:
+                    short_title = match.group(3)
+                    continue
+
+                if re.search(r".{58,}(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]+ (19[89][0-9]|20[0-9][0-9]) *$", line, re.I):
+                    continue
+                if re.search(r"^ *Internet.Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
+                    continue
+                if re.search(r"^ *(Internet.Draft|INTERNET.DRAFT)( {16,}).*$", line, re.I):
+                    continue
+                if re.search(r"^ *Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
+                    continue
+                if re.search(r"^RFC[ -]?[0-9]+.*( +)[12][0-9][0-9][0-9]$", line, re.I):
+                    continue
+                if re.search(r"^RFC[ -]?[0-9]+.*(  +)[12][0-9][0-9][0-9]$", line, re.I):
+                    continue
+                if re.search(r"^draft-[-a-z0-9_.]+.*[0-9][0-9][0-9][0-9]$", line, re.I):
+                    continue
+                if newpage and re.search(r"^ *draft-[-a-z0-9_.]+ *$", line, re.I):
+                    continue
+
+            break
+
+        j = len(lines)-1
+        count = 0
+        for j in range(len(lines)-1, 0, -1):
+            line = lines[j].txt
+            if len(line) == 0:
+                count += 1
+                continue
+
+            if re.search(r"(  *)(\S.*\S)?(  +)\[?[Pp]age [0-9ivx]+\]?[ \t\f]*$", line, re.I):
+                continue
+
+            break
+
+        sentence = 0
+        if count > 3:
+            sentence = True
+        elif re.search(r"[.:+]\)?$", line):
+            sentence = True
+        elif re.search(r"^[A-Z0-9][0-9]*\.", line):
+            sentence = True
+        elif re.search(r"^ +[o*+-]  ", line):
+            sentence = True
+        elif re.search(r"^ +(E[Mm]ail): ", line):
+            sentence = True
+        elif re.search(r"^ +(Table|Figure)( +\d+)?: ", line):
+            sentence = True
+        elif line.strip() and len(line) < 50:
+            sentence = True
+
+        if line.rstrip() and line.rstrip()[-1] == ',':
+            sentence = False
+
+        if sentence:
+            j += 1
+
+        stripped.extend(lines[i:j+1])
+
+    return stripped, short_title
+
+
+def benchStrip(repeat, number):
+    # Best of repeat runs, reported per call, against the reference version
+    totalOld = 0.0
+    totalNew = 0.0
+    print("{0:16} {1:>11} {2:>11} {3:>7}".format("", "old", "new", "ratio"))
+    for name, text in loadTexts().items():
+        if referenceStrip(text) != strip_pagebreaks(text):
+            print("{0:16} output differs from the reference".format(name))
+        old = min(timeit.repeat(lambda: referenceStrip(text), repeat=repeat, number=number)) / number
+        new = min(timeit.repeat(lambda: strip_pagebreaks(text), repeat=repeat, number=number)) / number
+        totalOld += old
+        totalNew += new
+        print("{0:16} {1:8.2f} ms {2:8.2f} ms {3:6.2f}x".format(name, old * 1000, new * 1000, old / new))
+    print("{0:16} {1:8.2f} ms {2:8.2f} ms {3:6.2f}x".format("total", totalOld * 1000, totalNew * 1000,
+                                                            totalOld / totalNew))
+
+
+def loadSections(perSection):
+    # The test RFCs cut into sections of 40 lines.  Each section has
+    # perSection errata quoting it, reflowed, one of them twice, and one
+    # erratum whose text it does not hold.
+    rand = random.Random(1)
+    texts = {}
+    quotes = {}
+    for name, text in loadTexts().items():
+        lines = text.splitlines()
+        for first in range(0, len(lines), 40):
+            section = "{0}/{1}".format(name, first)
+            texts[section] = "\n".join(lines[first:first+40])
+            words = texts[section].split()
+            if len(words) < 20:
+                continue
+            quotes[section] = ["no such text\n   in this section"]
+            for i in range(perSection):
+                start = rand.randrange(len(words) - 8)
+                quotes[section].append("\n   ".join(words[start:start + rand.randrange(3, 9)]))
+            quotes[section].append(quotes[section][-1])
+    return texts, quotes
+
+
+def oldPlacement(texts, quotes):
+    # One regular expression search per erratum, as before firstMatches
+    found = {}
+    for name, items in quotes.items():
+        for quote in items:
+            match = compilePattern(quote).search(texts[name])
+            if match:
+                found[(name, matchKey(quote))] = match.span()
+    return found
+
+
+def newPlacement(texts, quotes):
+    wanted = dict((name, set(matchKey(quote) for quote in items)) for name, items in quotes.items())
+    return firstMatches(texts, wanted, compilePattern)
+
+
+def benchPlacement(repeat, number):
+    # Best of repeat runs, reported per call, against the search per erratum
+    print("{0:16} {1:>11} {2:>11} {3:>7}".format("", "old", "new", "ratio"))
+    for perSection in [1, 4, 16]:
+        texts, quotes = loadSections(perSection)
+        if oldPlacement(texts, quotes) != newPlacement(texts, quotes):
+            print("{0:2} per section    output differs from the reference".format(perSection))
+        old = min(timeit.repeat(lambda: oldPlacement(texts, quotes), repeat=repeat, number=number)) / number
+        new = min(timeit.repeat(lambda: newPlacement(texts, quotes), repeat=repeat, number=number)) / number
+        print("{0:2} per section   {1:8.2f} ms {2:8.2f} ms {3:6.2f}x".format(perSection, old * 1000, new * 1000,
+                                                                             old / new))
+
+
+def loadErrata(count):
+    # errata.json as it comes from the server, made up from the test errata
+    samples = []
+    for fileName in sorted(glob.glob(os.path.join(testDir, "*.json"))):
+        with open(fileName, encoding='utf-8') as f:
+            samples.extend(json.load(f))
+    errata = []
+    for i in range(count):
+        item = dict(samples[i % len(samples)])
+        item["errata_id"] = i + 1
+        item["doc-id"] = "RFC{0}".format(1000 + i % 3000)
+        errata.append(item)
+    return json.dumps(errata)
+
+
+def benchRecords(count):
+    # Memory held by the errata as dicts and as Erratum records
+    text = loadErrata(count)
+
+    gc.collect()
+    tracemalloc.start()
+    errata = json.loads(text)
+    asDicts = tracemalloc.get_traced_memory()[0]
+    records = [Erratum(item) for item in errata]
+    del errata
+    gc.collect()
+    asRecords = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("{0} errata".format(len(records)))
+    print("{0:16} {1:8.2f} MiB".format("dicts", asDicts / 1048576))
+    print("{0:16} {1:8.2f} MiB".format("records", asRecords / 1048576))
+
+
+def main():
+    optionparser = optparse.OptionParser(usage='benchmark.py [OPTIONS]')
+    optionparser.add_option("--repeat", type="int", default=5, help="number of timing runs")
+    optionparser.add_option("--number", type="int", default=10, help="calls per timing run")
+    optionparser.add_option("--errata", type="int", default=8000, help="number of errata for the memory benchmark")
+    (options, args) = optionparser.parse_args()
+
+    benchStrip(options.repeat, options.number)
+    benchPlacement(options.repeat, options.number)
+    benchRecords(options.errata)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,21 @@
+import codecs
+import hashlib
 import json
+import pickle
 import re
 import os
 import datetime
 import shutil
+import threading
+import time
+import zlib
 import email.utils as eut
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from http.client import HTTPSConnection, HTTPException
-from Rfc_Errata.apply_errata import apply_errata
+from Rfc_Errata import __version__
+from Rfc_Errata.apply_errata import apply_errata, renderEnvironment, Erratum
+from Rfc_Errata.utils import file_digest
 
 
 def fixSection(sectionIn):
@@ -51,6 +60,102 @@ def fixSection(sectionIn):
     return section
 
 
+def rfcKey(docId):
+    "The name of an RFC as used for the keys of byRfc"
+    return 'rfc{0}'.format(int(docId[3:]))
+
+
+Separators = re.compile(r"[\s,]*")
+
+
+class errataParser(object):
+    """Parse errata.json as it arrives, a chunk at a time.
+
+    Each record is decoded once it is complete, so only the unfinished one
+    is held as text.  errata is the list of errata and index maps each RFC
+    to the byte ranges of its records, or is None if the file is not a list.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.text = ""
+        self.pos = 0
+        self.offset = 0
+        self.errata = []
+        self.index = {}
+        self.state = "start"
+
+    def feed(self, data, final=False):
+        self.text += self.decoder.decode(data, final)
+        text = self.text
+        pos = self.pos
+
+        if self.state == "start":
+            pos = Separators.match(text, pos).end()
+            if pos == len(text) and not final:
+                return
+            if text[pos:pos+1] == "[":
+                self.state = "list"
+                pos += 1
+                self.offset += len(text[:pos].encode('utf-8'))
+                text = text[pos:]
+                pos = 0
+            else:
+                self.state = "other"
+
+        if self.state == "list":
+            last = 0
+            while True:
+                pos = Separators.match(text, pos).end()
+                if pos == len(text) and not final:
+                    break
+                if text[pos:pos+1] == "]":
+                    self.state = "done"
+                    break
+                try:
+                    item, end = self.json.raw_decode(text, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                self.errata.append(item)
+
+                self.offset += len(text[last:pos].encode('utf-8'))
+                start = self.offset
+                self.offset += len(text[pos:end].encode('utf-8'))
+                last = pos = end
+
+                try:
+                    self.index.setdefault(rfcKey(item["doc-id"]), []).append([start, self.offset])
+                except (KeyError, TypeError, ValueError):
+                    pass
+
+            # Drop the records already decoded
+            self.offset += len(text[last:pos].encode('utf-8'))
+            text = text[pos:]
+            pos = 0
+        elif self.state == "other" and final:
+            self.errata = json.loads(text)
+            self.index = None
+
+        if self.state == "done":
+            text = ""
+        self.text = text
+        self.pos = pos
+
+
+def parseErrata(data):
+    """Parse the bytes of errata.json.
+
+    Returns the list of errata and an index from RFC to the byte ranges of
+    its records in data, or None for the index if data is not a list.
+    """
+    parser = errataParser()
+    parser.feed(data, True)
+    return parser.errata, parser.index
+
+
 IgnoreSections = ["99", "global", "none", "", "index", "all", "n/a", "various"]
 Reported = ["RFC0090", "RFC1033", "RFC2069", "RFC2821", "RFC3032", "RFC3696", "RFC3719",
             "RFC3810", "RFC4207", "RFC4301", "RFC5570", "RFC5663", "RFC6426"]
@@ -62,6 +167,55 @@ Reported = ["RFC0090", "RFC1033", "RFC2069", "RFC2821", "RFC3032", "RFC3696", "R
 # RFC 4302 - B2 is the appendix
 # RFC 3696 - bad errata section # - augmented original text
 
+FetchRetries = 3
+ManifestFile = "manifest.json"
+IndexFile = "errata.idx"
+SnapshotFile = "errata.snapshot"
+ChunkSize = 64 * 1024
+MaxRemovals = 10
+
+
+def logError(errText):
+    with open("errors.log", "a") as f:
+        f.write(datetime.datetime.now().isoformat() + ": " + errText + "\n")
+
+
+def readChunks(res, gzipped):
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while True:
+        chunk = res.read(ChunkSize)
+        if not chunk:
+            break
+        yield decoder.decompress(chunk) if decoder else chunk
+    if decoder:
+        yield decoder.flush()
+
+
+# Each process in the pool gets its own checker, and with it its own connection
+# and apply_errata instances.  Only the counts travel back to the parent.  The
+# texts the parent failed to prefetch are handed over so no worker tries again.
+
+workerChecker = None
+workerTemplates = None
+
+
+def initWorker(options, state, templates, fetchFailed):
+    global workerChecker, workerTemplates
+    workerChecker = checker(options, state)
+    workerChecker.fetchFailed = fetchFailed
+    workerTemplates = templates
+
+
+def processWorker(job):
+    rfc, items = job
+    workerChecker.byRfc = {rfc: items} if items else {}
+    workerChecker.inlineCount = 0
+    workerChecker.sectionCount = 0
+    workerChecker.endnoteCount = 0
+
+    errorCount = workerChecker.processRFC(rfc, workerChecker.options.force, workerTemplates)
+    return errorCount, workerChecker.inlineCount, workerChecker.sectionCount, workerChecker.endnoteCount
+
 
 class checker(object):
     def __init__(self, options, state):
@@ -71,10 +225,26 @@ class checker(object):
         self.sectionCount = 0
         self.endnoteCount = 0
         self.connection = None
+        self.errata = None
+        self.byRfc = None
+
+        # The digest of errata.json when self.errata holds all of it
+        self.errataDigest = None
+
+        # Text downloads use one keep-alive connection per fetch thread
+
+        self.connectionClass = HTTPSConnection
+        self.fetchBackoff = 0.5
+        self.fetchLocal = threading.local()
+        self.fetchLock = threading.Lock()
+        self.fetchConnections = []
+        self.fetchFailed = set()
 
     # --- Download JSON file with errata data -------------------------
 
-    def loadErrata(self):
+    def loadErrata(self, rfcs=None):
+        # With a list of RFCs only their errata are needed, and the index
+        # finds them without parsing the whole of errata.json
 
         result = True
         if not self.options.no_network:
@@ -82,22 +252,38 @@ class checker(object):
                 # Nothing to be done
                 result = False
 
-        with open("errata.json", encoding='utf-8') as f:
-            self.errata = json.load(f)
+        if self.errata is None and rfcs is not None:
+            self.errata = self.loadIndexed(rfcs)
+
+        if self.errata is None:
+            digest = file_digest("errata.json")
+            if self.loadSnapshot(digest):
+                return result
+            with open("errata.json", "rb") as f:
+                self.errata, index = parseErrata(f.read())
+            self.errataDigest = digest
+            if self.readIndex() is None:
+                self.writeIndex(index)
 
         return result
 
     def filterErrata(self):
 
+        # Already done by the snapshot of an earlier run
+        if self.errata is None and self.byRfc is not None:
+            return
+
         # Gather together the set of errata we are going to emit
 
         byRfc = {}
+        fingerprints = {}
         emitCodes = self.state["which"]
         # emitCodes = ["Verified", "Held"]
 
-        for item in self.errata:
+        for fields in self.errata:
+            item = Erratum(fields)
             item["section2"] = fixSection(item["section"]).lower()
-            item["doc-id"] = 'rfc{0}'.format(int(item["doc-id"][3:]))
+            item["doc-id"] = rfcKey(item["doc-id"])
 
             if item["errata_status_code"] == "Held for Document Update":
                 item["status_tag"] = "Held"
@@ -109,9 +295,40 @@ class checker(object):
 
             if not item["doc-id"] in byRfc:
                 byRfc[item["doc-id"]] = []
+                fingerprints[item["doc-id"]] = {}
 
             byRfc[item["doc-id"]].append(item)
+            fingerprints[item["doc-id"]][str(item["errata_id"])] = \
+                hashlib.sha1(json.dumps(item.asDict(), sort_keys=True).encode('utf-8')).hexdigest()
         self.byRfc = byRfc
+        self.fingerprints = fingerprints
+        if self.errataDigest is not None:
+            self.saveSnapshot(self.errataDigest)
+
+        # The records hold everything needed from here on
+        self.errata = None
+
+    # --- Snapshot of the filtered errata -------------------------------
+
+    def snapshotKey(self, digest):
+        # The filtered errata depend on errata.json and the statuses applied
+        return "{0}:{1}:{2}".format(__version__, digest, ",".join(sorted(self.state["which"])))
+
+    def loadSnapshot(self, digest):
+        try:
+            with open(SnapshotFile, "rb") as f:
+                if pickle.load(f) != self.snapshotKey(digest):
+                    return False
+                self.byRfc, self.fingerprints = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            return False
+        return True
+
+    def saveSnapshot(self, digest):
+        with open(SnapshotFile + ".tmp", "wb") as f:
+            pickle.dump(self.snapshotKey(digest), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((self.byRfc, self.fingerprints), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(SnapshotFile + ".tmp", SnapshotFile)
 
     def processRFC(self, rfc, force, templates):
         if rfc not in self.byRfc:
@@ -122,34 +339,8 @@ class checker(object):
             txt_file = os.path.join(self.state["text"], "{0}.txt".format(rfc))
 
             if not os.path.isfile(txt_file):
-                retries = 3
-                while retries:
-                    try:
-                        if not self.connection:
-                            self.connection = HTTPSConnection(self.state["serverName"])
-
-                        # print("RFC = {0}".format(rfc))
-                        rfcNum = int(rfc[3:])
-                        self.connection.request('GET', '/rfc/rfc{0}.txt'.format(rfcNum).lower())
-                        res = self.connection.getresponse()
-                        with open(txt_file, "wb") as f:
-                            f.write(res.read())
-                        retries = 0
-                    except HTTPException as e:
-                        if retries:
-                            if self.options.verbose:
-                                print("Close and reopen connection because '{0}'".format(e))
-
-                            self.connection.close()
-                            self.connection = None
-                            retries -= 1
-                        else:
-                            errText = "Error '{1}' downloading 'errata.json' from '{0}'".format(self.state["serverName"], e)
-                            if self.options.verbose:
-                                print(errText)
-                            with open("errors.log", "a") as f:
-                                f.write(datetime.datetime.now().isoformat() + ": " + errText)
-                            return 1
+                if rfc in self.fetchFailed or self.downloadText(rfc):
+                    return 1
 
             x = apply_errata(self.byRfc[rfc], self.options, self.state)
             x.apply(force, templates)
@@ -182,14 +373,196 @@ class checker(object):
 
     def processAllRfcs(self, templates):
 
-        # create the output directories if needed
+        # Without a manifest from a previous run everything is a candidate,
+        # otherwise only the RFCs whose errata changed need to be rendered.
+        # Either way the render cache makes the final decision.
 
-        byRfcOrdered = sorted(self.byRfc)
-        errorCount = 0
+        self.loadManifest(renderEnvironment(templates, self.options, self.state))
+        if self.options.force or self.manifest is None:
+            rfcs = sorted(self.byRfc)
+        else:
+            rfcs = sorted(self.changedRfcs())
+            if self.options.verbose:
+                print("{0} RFCs have changed errata".format(len(rfcs)))
+
+        # An RFC that lost its last erratum loses its page as well.  So many
+        # going at once more likely means a damaged errata.json, so then
+        # nothing is removed and they stay in the manifest for the next run.
+
+        withdrawn = [rfc for rfc in rfcs if rfc not in self.byRfc]
+        rfcs = [rfc for rfc in rfcs if rfc in self.byRfc]
+        removeErrors = 0
+        maxRemovals = getattr(self.options, "max_removals", MaxRemovals)
+        if len(withdrawn) > maxRemovals:
+            errText = "{0} RFCs no longer have any errata, more than the {1} allowed; " \
+                      "no pages were removed".format(len(withdrawn), maxRemovals)
+            print(errText)
+            logError(errText)
+            withdrawn = []
+            removeErrors = 1
+        for rfc in withdrawn:
+            print("Removing the page of {0}, which no longer has any errata".format(rfc))
+            self.removePage(rfc)
+
+        try:
+            self.prefetchTexts(rfcs)
 
-        for rfc in byRfcOrdered:
-            errorCount += self.processRFC(rfc, self.options.force, templates)
-        return errorCount
+            if self.options.jobs > 1:
+                results = self.processPool(rfcs, templates)
+            else:
+                results = [self.processRFC(rfc, self.options.force, templates) for rfc in rfcs]
+        finally:
+            self.closeConnections()
+
+        self.writeManifest(withdrawn + [rfc for rfc, errors in zip(rfcs, results) if errors == 0])
+        return sum(results) + removeErrors
+
+    def removePage(self, rfc):
+        htmlFile = rfc + ".html"
+        files = [os.path.join(self.state["html"], htmlFile), os.path.join(self.state["html"], rfc + ".key")]
+        for dest in self.state.get("dest", []):
+            files.append(os.path.join(dest, htmlFile))
+        for fileName in files:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def processPool(self, rfcs, templates):
+        # Results come back in submission order, so the totals do not depend
+        # on which worker finished first.
+
+        jobs = [(rfc, self.byRfc.get(rfc)) for rfc in rfcs]
+        results = []
+
+        with ProcessPoolExecutor(max_workers=self.options.jobs, initializer=initWorker,
+                                 initargs=(self.options, self.state, templates,
+                                           self.fetchFailed)) as pool:
+            for errors, inline, section, endnote in pool.map(processWorker, jobs, chunksize=4):
+                results.append(errors)
+                self.inlineCount += inline
+                self.sectionCount += section
+                self.endnoteCount += endnote
+        return results
+
+    # --- Track which errata each RFC was last rendered with -----------
+
+    def loadManifest(self, environment):
+        # A manifest written with other templates, css path or version says
+        # nothing about the current output.
+
+        self.environment = environment
+        try:
+            with open(os.path.join(self.state["html"], ManifestFile), encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("environment") == environment:
+                self.manifest = manifest["rfcs"]
+            else:
+                self.manifest = None
+        except (IOError, ValueError):
+            self.manifest = None
+
+    def changedRfcs(self):
+        # An RFC changes when any of its errata were added, removed or edited.
+        # One that lost its html file is rendered again as well.
+
+        changed = set()
+        for rfc in set(self.fingerprints) | set(self.manifest):
+            if self.fingerprints.get(rfc) != self.manifest.get(rfc):
+                changed.add(rfc)
+            elif not os.path.exists(os.path.join(self.state["html"], rfc + ".html")):
+                changed.add(rfc)
+        return changed
+
+    def writeManifest(self, done):
+        manifest = dict(self.manifest or {})
+        for rfc in done:
+            if rfc in self.fingerprints:
+                manifest[rfc] = self.fingerprints[rfc]
+            else:
+                manifest.pop(rfc, None)
+
+        fileName = os.path.join(self.state["html"], ManifestFile)
+        with open(fileName + ".tmp", "w", encoding='utf-8') as f:
+            json.dump({"environment": self.environment, "rfcs": manifest}, f)
+        os.replace(fileName + ".tmp", fileName)
+        self.manifest = manifest
+
+    # --- Download the text versions of the RFCs ----------------------
+
+    def getConnection(self):
+        connection = getattr(self.fetchLocal, "connection", None)
+        if connection is None:
+            connection = self.connectionClass(self.state["serverName"])
+            self.fetchLocal.connection = connection
+            with self.fetchLock:
+                self.fetchConnections.append(connection)
+        return connection
+
+    def dropConnection(self):
+        connection = getattr(self.fetchLocal, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.fetchLocal.connection = None
+
+    def closeConnections(self):
+        with self.fetchLock:
+            for connection in self.fetchConnections:
+                connection.close()
+            self.fetchConnections = []
+            self.fetchLocal = threading.local()
+
+    def downloadText(self, rfc):
+        txt_file = os.path.join(self.state["text"], "{0}.txt".format(rfc))
+        url = '/rfc/rfc{0}.txt'.format(int(rfc[3:]))
+
+        for attempt in range(FetchRetries):
+            if attempt:
+                time.sleep(self.fetchBackoff * 2 ** (attempt-1))
+            # Only network errors are retried, a failure to write the text is not
+            try:
+                connection = self.getConnection()
+                connection.request('GET', url)
+                res = connection.getresponse()
+                body = res.read()
+            except (HTTPException, OSError) as e:
+                errText = "Error '{1}' downloading '{2}' from '{0}'".format(self.state["serverName"], e, url)
+                self.dropConnection()
+            else:
+                if res.status == 200:
+                    with open(txt_file + ".tmp", "wb") as f:
+                        f.write(body)
+                    os.replace(txt_file + ".tmp", txt_file)
+                    return 0
+
+                errText = "Error {0} for 'GET {1}' on '{2}'".format(res.status, url, self.state["serverName"])
+                if res.status < 500:
+                    break
+
+            if self.options.verbose:
+                print("Retrying because '{0}'".format(errText))
+
+        if self.options.verbose:
+            print(errText)
+        logError(errText)
+        with self.fetchLock:
+            self.fetchFailed.add(rfc)
+        return 1
+
+    def prefetchTexts(self, rfcs):
+        # Fetch every missing text before rendering starts
+
+        missing = [rfc for rfc in rfcs
+                   if not os.path.isfile(os.path.join(self.state["text"], "{0}.txt".format(rfc)))]
+        if not missing:
+            return 0
+
+        if self.options.verbose:
+            print("downloading {0} RFCs".format(len(missing)))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.options.fetch_jobs) as pool:
+                return sum(pool.map(self.downloadText, missing))
+        finally:
+            self.closeConnections()
 
     def printStats(self, errorCount):
         if self.options.verbose:
@@ -206,87 +579,151 @@ class checker(object):
             if errorCount > 0:
                 print("Error Count: {0}".format(errorCount))
 
-    def downloadErrataFile(self):
+    def saveErrataFile(self, res, gzipped=False):
+        # Stream the body to a temporary file, normalising escaped CRLFs on the
+        # way through.  The tail of each chunk is held back so that a sequence
+        # split across two reads is still replaced.  The errata are parsed and
+        # indexed from the same chunks, so the body is never held in full.
+
+        tmpFile = "errata.json.tmp"
+        parser = errataParser()
+        try:
+            pending = b""
+            with open(tmpFile, "wb") as f:
+                for chunk in readChunks(res, gzipped):
+                    chunk = (pending + chunk).replace(b"\\r\\n", b"\\n")
+                    pending = chunk[-3:]
+                    f.write(chunk[:-3])
+                    parser.feed(chunk[:-3])
+                f.write(pending)
+                parser.feed(pending, True)
+            data, index = parser.errata, parser.index
+        except Exception:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+
+        os.replace(tmpFile, "errata.json")
+        self.writeIndex(index)
+        self.errataDigest = file_digest("errata.json")
+        return data
+
+    # --- Index of the records of each RFC in errata.json ---------------
+
+    def writeIndex(self, index):
+        # The size and time of errata.json tell a stale index from a good one
+
+        if index is None:
+            return
+        stat = os.stat("errata.json")
+        data = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "rfcs": index}
+        with open(IndexFile + ".tmp", "w", encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(IndexFile + ".tmp", IndexFile)
+
+    def readIndex(self):
         try:
-            self.connection = HTTPSConnection(self.state["serverName"])
-            lastModified = None
-            if os.path.exists("errata.json"):
-                self.connection.request('HEAD', '/errata.json')
+            with open(IndexFile, encoding='utf-8') as f:
+                data = json.load(f)
+            stat = os.stat("errata.json")
+        except (OSError, ValueError):
+            return None
+        if data.get("size") != stat.st_size or data.get("mtime") != stat.st_mtime_ns:
+            return None
+        return data.get("rfcs")
+
+    def loadIndexed(self, rfcs):
+        # Read only the records of the given RFCs, if the index is current
+
+        index = self.readIndex()
+        if index is None:
+            return None
+
+        errata = []
+        with open("errata.json", "rb") as f:
+            for rfc in rfcs:
+                for start, end in index.get(rfc, []):
+                    f.seek(start)
+                    errata.append(json.loads(f.read(end - start).decode('utf-8')))
+        return errata
+
+    def downloadErrataFile(self):
+        # A single conditional GET.  A 304 means that the copy we have is
+        # current, otherwise the (possibly gzipped) body replaces it.
+
+        headers = {"Accept-Encoding": "gzip"}
+        if os.path.exists("errata.json"):
+            if "etag" in self.state:
+                headers["If-None-Match"] = self.state["etag"]
+            headers["If-Modified-Since"] = self.state["lastCheck"]
+
+        retries = 2
+        while True:
+            try:
+                if self.connection is None:
+                    self.connection = self.connectionClass(self.state["serverName"])
+                self.connection.request('GET', '/errata.json', headers=headers)
                 res = self.connection.getresponse()
+
+                if res.status == 304:
+                    res.read()
+                    if self.options.verbose:
+                        print("errata.json is up to date.")
+                    return False
+
                 if res.status != 200:
-                    print("Error {0} for 'HEAD /errata.json' on '{1}'".format(res.status,
-                                                                              self.state["serverName"]))
+                    errText = "Error {0} for 'GET /errata.json' on '{1}'".format(res.status,
+                                                                                 self.state["serverName"])
+                    print(errText)
+                    logError(errText)
                     exit(1)
-                res.read()
 
-                lastModified = eut.parsedate_to_datetime(res.getheader("Last-Modified",
-                                                                       "Mon, 22 Apr 2019 00:00:00 GMT"))
-                if lastModified <= eut.parsedate_to_datetime(self.state["lastCheck"]):
+                # Servers that ignore the conditional headers still tell us
+                # the date, so there is no need to read the body.
+
+                lastModified = res.getheader("Last-Modified")
+                if "If-Modified-Since" in headers and lastModified and \
+                   eut.parsedate_to_datetime(lastModified) <= eut.parsedate_to_datetime(self.state["lastCheck"]):
+                    self.connection.close()
+                    self.connection = None
                     if self.options.verbose:
                         print("errata.json is up to date.")
-                        self.state["lastCheck"] = res.getheader("Last-Modified")
                     return False
 
-            #  Should not eed to do this, but it doesn't work otherwise
-            if self.options.verbose:
-                print("downloading new copy of errata.json")
+                if self.options.verbose:
+                    print("downloading new copy of errata.json")
+                    if "If-Modified-Since" in headers:
+                        print("Old: {0}\nNew:{1}".format(self.state["lastCheck"], lastModified))
+
+                gzipped = res.getheader("Content-Encoding", "").lower() == "gzip"
+                self.errata = self.saveErrataFile(res, gzipped)
+
                 if lastModified:
-                    print("Old: {0}\nNew:{1}".format(self.state["lastCheck"], lastModified))
+                    self.state["lastCheck"] = lastModified
+                etag = res.getheader("ETag")
+                if etag:
+                    self.state["etag"] = etag
+                elif "etag" in self.state:
+                    del self.state["etag"]
+                return True
+
+            except HTTPException as e:
+                if retries:
+                    if self.options.verbose:
+                        print("Close and reopen connection because '{0}'".format(e))
 
-            retries = 2
-            while retries:
-                try:
-                    if self.connection is None:
-                        self.connection = HTTPSConnection(self.state["serverName"])
-                    self.connection.request('GET', '/errata.json')
-                    res = self.connection.getresponse()
-                    if res.status != 200:
-                        errText = "Error {0} for 'HEAD /errata.json' on '{1}'".format(res.status,
-                                                                                      self.state["serverName"])
-                        print(errText)
-                        with open("errors.log", "a") as f:
-                            f.write(datetime.datetime.now().isoformat() + ": " + errText)
-                        exit(1)
-                    with open("errata.json", "w") as f:
-                        f.write(res.read().decode('utf-8').replace("\\r\\n", "\\n"))
-
-                    if True:
-                        with open("errata.json") as f:
-                            data = json.load(f)
-
-                        with open("errata.json", "w") as f:
-                            json.dump(data, f, indent=2)
-
-                    retries = 0
-                    self.state["lastCheck"] = res.getheader("Last-Modified")
-                except HTTPException as e:
-                    if retries:
-                        if self.options.verbose:
-                            print("Close and reopen connection because '{0}'".format(e))
-
-                        self.connection.close()
-                        self.connection = None
-                        retries -= 1
-                    else:
-                        errText = "Error '{1}' downloading 'errata.json' from '{0}'".format(self.state["serverName"], e)
-                        if self.options.verbose:
-                            print(errText)
-                        with open("errors.log", "a") as f:
-                            f.write(datetime.datetime.now().isoformat() + ": " + errText)
-                        exit(1)
-                except Exception as e:
+                    self.connection.close()
+                    self.connection = None
+                    retries -= 1
+                else:
                     errText = "Error '{1}' downloading 'errata.json' from '{0}'".format(self.state["serverName"], e)
                     if self.options.verbose:
                         print(errText)
-                    with open("errors.log", "a") as f:
-                        f.write(datetime.datetime.now().isoformat() + ": " + errText)
+                    logError(errText)
                     exit(1)
-
-        except HTTPException as e:
-            errText = "Error '{1}' downloading 'errata.json' from '{0}'".format(self.state["serverName"], e)
-            if self.options.verbose:
-                print(errText)
-            with open("errors.log", "a") as f:
-                f.write(datetime.datetime.now().isoformat() + ": " + errText)
-            exit(1)
-        return True
+            except Exception as e:
+                errText = "Error '{1}' downloading 'errata.json' from '{0}'".format(self.state["serverName"], e)
+                if self.options.verbose:
+                    print(errText)
+                logError(errText)
+                exit(1)
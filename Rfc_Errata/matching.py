@@ -0,0 +1,188 @@
+import re
+import bisect
+import time
+
+
+class SectionIndex(object):
+    """Inverted index from the words of a document to the sections holding them.
+
+    The errata patterns match their text with any run of whitespace between
+    the words.  Every word except the first and the last is then bounded by
+    whitespace on both sides, so it has to occur as a whole word in any
+    section that can match.  Intersecting those words narrows the search
+    down to a few candidate sections, which are then confirmed with the
+    regular expression.
+    """
+
+    def __init__(self, sections):
+        self.names = list(sections)
+        self.all = (1 << len(self.names)) - 1
+        self.words = {}
+        for bit, name in enumerate(self.names):
+            mask = 1 << bit
+            for word in set(sections[name].split()):
+                self.words[word] = self.words.get(word, 0) | mask
+
+    def lookup(self, text):
+        "Return the set of sections that can hold text as a bit mask"
+        mask = self.all
+        for word in text.split()[1:-1]:
+            mask &= self.words.get(word, 0)
+            if not mask:
+                break
+        return mask
+
+    def sections(self, mask):
+        "Yield the names of the sections in mask in document order"
+        while mask:
+            low = mask & -mask
+            yield self.names[low.bit_length() - 1]
+            mask ^= low
+
+
+Whitespace = re.compile(r"\s+")
+
+
+def normaliseText(text):
+    """Collapse every run of whitespace to a single space.
+
+    Returns the new text and an OffsetMap leading back to the original.
+    """
+    parts = []
+    breaks = []
+    shifts = []
+    last = 0
+    shift = 0
+    for match in Whitespace.finditer(text):
+        parts.append(text[last:match.start()])
+        parts.append(" ")
+        if match.end() - match.start() > 1:
+            breaks.append(match.start() - shift + 1)
+            shift += match.end() - match.start() - 1
+            shifts.append(shift)
+        last = match.end()
+    parts.append(text[last:])
+    return "".join(parts), OffsetMap(breaks, shifts)
+
+
+class OffsetMap(object):
+    "Maps offsets in a whitespace normalised text back to the original"
+
+    def __init__(self, breaks, shifts):
+        self.breaks = breaks
+        self.shifts = shifts
+
+    def offset(self, pos):
+        i = bisect.bisect_right(self.breaks, pos)
+        return pos + self.shifts[i-1] if i else pos
+
+    def span(self, start, end):
+        if start == end:
+            return self.offset(start), self.offset(start)
+        return self.offset(start), self.offset(end-1) + 1
+
+
+def matchKey(text):
+    "The whitespace normalised form of text that firstMatches looks for"
+    return " ".join(text.split())
+
+
+def firstMatches(texts, wanted, compile):
+    """Find the first occurrence of each wanted string in each text.
+
+    texts maps a name to a text, and wanted maps the same names to sets of
+    strings already passed through matchKey.  compile turns a string into
+    the regular expression for it, so that the patterns are shared with
+    the ones used to apply the edits.  Each distinct string is searched for
+    once per text, however many errata quote it.  The result maps
+    (name, string) to the (start, end) span of the first occurrence.
+    """
+    found = {}
+    for name, keys in wanted.items():
+        text = texts[name]
+        for key in keys:
+            match = compile(key).search(text)
+            if match:
+                found[(name, key)] = match.span()
+    return found
+
+
+# Typographic characters that submitters often use in place of the plain ones
+# in the RFC text, mapped one for one so that offsets do not move
+FuzzyFold = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201B": "'",
+                           "\u201C": '"', "\u201D": '"',
+                           "\u2013": "-", "\u2014": "-"})
+
+
+def editScan(pattern, text, deadline, anchored=False):
+    """Myers' bit-parallel approximate search of text for pattern.
+
+    Returns (distance, end) for the end offset in text where pattern matches
+    with the fewest edits, or None if the deadline passed first.  An anchored
+    match has to start at the beginning of text.
+    """
+    size = len(pattern)
+    peq = {}
+    for i, ch in enumerate(pattern):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    mask = (1 << size) - 1
+    high = 1 << (size - 1)
+
+    pv = mask
+    mv = 0
+    carry = 1 if anchored else 0
+    score = size
+    best = (size, 0)
+    for pos, ch in enumerate(text):
+        if not pos & 1023 and time.monotonic() > deadline:
+            return None
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+            if score < best[0]:
+                best = (score, pos + 1)
+        ph = ((ph << 1) | carry) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best
+
+
+def fuzzyFind(pattern, text, minConfidence, budget):
+    """Find the closest approximate occurrence of pattern in text.
+
+    Whitespace runs count as a single space and typographic quotes and dashes
+    as their plain forms.  The confidence is one less the edit distance over
+    the length of the pattern.  Returns (start, end, confidence) for the best
+    match at or above minConfidence, or None when there is none or the search
+    takes longer than budget seconds.
+    """
+    deadline = time.monotonic() + budget
+    pattern = matchKey(pattern).translate(FuzzyFold)
+    if not pattern:
+        return None
+    text, offsets = normaliseText(text)
+    text = text.translate(FuzzyFold)
+
+    found = editScan(pattern, text, deadline)
+    if found is None or 1 - found[0] / len(pattern) < minConfidence:
+        return None
+    distance, end = found
+
+    # Scan backwards from the end to find where the match starts.  The scan
+    # is anchored at the end, so that the start belongs to the same alignment.
+
+    window = text[max(0, end - len(pattern) - distance):end]
+    found = editScan(pattern[::-1], window[::-1], deadline, True)
+    if found is None or found[0] != distance:
+        return None
+    start = end - found[1]
+
+    start, end = offsets.span(start, end)
+    return start, end, 1 - distance / len(pattern)
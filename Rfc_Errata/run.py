@@ -2,7 +2,7 @@ import json
 import sys
 import os
 import optparse
-from Rfc_Errata.checker import checker
+from Rfc_Errata.checker import checker, rfcKey, MaxRemovals
 # from rfc2html import markup
 from Rfc_Errata.template import Templates
 from Rfc_Errata.__init__ import __version__
@@ -33,6 +33,8 @@ def main2():
                               help="specify the server to download from as DNS name")
     server_options.add_option("--no-network", action='store_true', default=False,
                               help='don\'t use the network to resolve references')
+    server_options.add_option("--fetch-jobs", type="int", default=8,
+                              help="number of RFCs to download at the same time")
     optionparser.add_option_group(server_options)
 
     item_options = optparse.OptionGroup(optionparser, "Directory Options")
@@ -40,6 +42,7 @@ def main2():
     item_options.add_option("--text", help="Directory to store text versions in")
     item_options.add_option("--html", help="Directory to store html versions in")
     item_options.add_option("--css", help="Directory containing CSS and JavaScript files")
+    item_options.add_option("--cache", help="Directory to store preprocessed RFCs in")
     item_options.add_option("--copyto", action="append",
                             help="Specify a destination to copy the html file, may occur multiple times")
     item_options.add_option("--nocopy", action='store_true', help="Don't copy html files anywhere")
@@ -49,6 +52,8 @@ def main2():
     item_options.add_option("--all", help="Apply to all RFCs", action='store_true')
     item_options.add_option("--search", action='store_false', default=True,
                             help="Don't search for non-sectioned errata")
+    item_options.add_option("--fuzzy", action='store_true', default=False,
+                            help="place errata whose text differs slightly from the RFC")
     item_options.add_option("--path", help="path to css files in HTML output")
     item_options.add_option("--reported", help="apply reported errata (yes/no)")
     item_options.add_option("--held", help="apply held for update errata (yes/no)")
@@ -61,6 +66,10 @@ def main2():
                             help='print extra information')
     item_options.add_option("--force", action='store_true',
                             help='Force regeneration of html files.')
+    item_options.add_option("-j", "--jobs", type="int", default=1,
+                            help='number of worker processes to use with --all')
+    item_options.add_option("--max-removals", type="int", default=MaxRemovals,
+                            help='most pages of RFCs without errata to remove in one run with --all')
     item_options.add_option('-V', '--version', action='callback', callback=display_version,
                             help='display the version number and exit')
     optionparser.add_option_group(item_options)
@@ -81,6 +90,7 @@ def main2():
             "which": ["Verified", "Held"],
             "text": "./rfc",
             "html": "./html",
+            "cache": "./cache",
             "ossPath": "./css"
         }
 
@@ -102,6 +112,10 @@ def main2():
         state["html"] = options.html
         updateState = True
 
+    if options.cache and options.cache != state.get("cache"):
+        state["cache"] = options.cache
+        updateState = True
+
     if options.path and options.path != state["cssPath"]:
         state["cssPath"] = options.path
         updateState = True
@@ -169,9 +183,21 @@ def main2():
         state["dest"] = options.copyto
         updateState = True
 
+    # The RFCs named on the command line, in the form used by the checker
+
+    rfcs = []
+    for rfc in args:
+        rfc = rfc.upper()
+        if not rfc.startswith("RFC"):
+            rfc = "RFC" + rfc
+        if not rfc[3:].isdigit():
+            print("Only RFCs can be provided for update.  Use RFCXXXX")
+            continue
+        rfcs.append(rfcKey(rfc))
+
     check = checker(options, state)
 
-    if check.loadErrata():
+    if check.loadErrata(None if options.all else rfcs):
         updateState = True
     check.filterErrata()
 
@@ -181,6 +207,8 @@ def main2():
         os.mkdir(state["text"])
     if not os.path.isdir(state["html"]):
         os.mkdir(state["html"])
+    if "cache" in state and not os.path.isdir(state["cache"]):
+        os.mkdir(state["cache"])
 
     if "templateDir" in state:
         templates_path = state["templateDir"]
@@ -192,21 +220,17 @@ def main2():
     if options.all:
         errorCount = check.processAllRfcs(templates)
     else:
-        for rfc in args:
-            rfc = rfc.upper()
-            if not rfc.startswith("RFC"):
-                if rfc.isdigit():
-                    rfc = "RFC" + rfc
-                else:
-                    print("Only RFCs can be provided for update.  Use RFCXXXX")
-
-            errorCount += check.processRFC(rfc, options.force, templates)
-            # if False:
-            #    with open('rfc/' + rfc + '.txt') as f:
-            #        text = f.read()
-            #    html = markup(text)
-            #    with open('html2/' + rfc + '.html', "w") as f:
-            #        f.write(html)
+        try:
+            for rfc in rfcs:
+                errorCount += check.processRFC(rfc, options.force, templates)
+                # if False:
+                #    with open('rfc/' + rfc + '.txt') as f:
+                #        text = f.read()
+                #    html = markup(text)
+                #    with open('html2/' + rfc + '.html', "w") as f:
+                #        f.write(html)
+        finally:
+            check.closeConnections()
 
     check.printStats(errorCount)
 
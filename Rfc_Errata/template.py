@@ -1,16 +1,80 @@
 import os
+import hashlib
 from string import Template
+from collections.abc import Iterator
+
+
+class CompiledTemplate(object):
+    """A string.Template split into literal text and field names when loaded.
+
+    Rendering joins the pieces, or writes them to a stream, without scanning
+    the template again.  The output and the errors are those of Template.
+    A field can also be an iterator of strings, which is rendered in turn so
+    that large fields never need to be held as one string.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.segments = []
+        self.invalid = None
+
+        literal = ""
+        last = 0
+        for match in Template.pattern.finditer(template):
+            literal += template[last:match.start()]
+            last = match.end()
+            name = match.group("named") or match.group("braced")
+            if name is not None:
+                self.segments.append((literal, name))
+                literal = ""
+            elif match.group("escaped") is not None:
+                literal += Template.delimiter
+            elif self.invalid is None:
+                lines = template[:match.start("invalid")].splitlines(True)
+                if not lines:
+                    self.invalid = (1, 1)
+                else:
+                    self.invalid = (len(lines), len(lines[-1]))
+        self.segments.append((literal + template[last:], None))
+
+    def pieces(self, mapping, kws):
+        if self.invalid:
+            raise ValueError('Invalid placeholder in string: line %d, col %d' % self.invalid)
+        for literal, name in self.segments:
+            yield literal
+            if name is not None:
+                value = kws[name] if name in kws else mapping[name]
+                if isinstance(value, str):
+                    yield value
+                elif isinstance(value, Iterator):
+                    yield from value
+                else:
+                    yield str(value)
+
+    def substitute(self, mapping={}, **kws):
+        return "".join(self.pieces(mapping, kws))
+
+    def write(self, f, mapping={}, **kws):
+        "Write the template to f a piece at a time rather than as one string"
+        for piece in self.pieces(mapping, kws):
+            f.write(piece)
 
 
 class Templates(object):
     def __init__(self, templateDir):
         with open(os.path.join(templateDir, "sectionNoteTemplate.txt")) as f:
-            self.sectionNote = Template(f.read())
+            self.sectionNote = CompiledTemplate(f.read())
         with open(os.path.join(templateDir, "inlineNoteTemplate.txt")) as f:
-            self.inlineNote = Template(f.read())
+            self.inlineNote = CompiledTemplate(f.read())
         with open(os.path.join(templateDir, "endnoteTemplate.txt")) as f:
-            self.endNote = Template(f.read())
+            self.endNote = CompiledTemplate(f.read())
         with open(os.path.join(templateDir, "headnoteTemplate.txt")) as f:
-            self.headNote = Template(f.read())
+            self.headNote = CompiledTemplate(f.read())
         with open(os.path.join(templateDir, "htmlTemplate.txt")) as f:
-            self.html = Template(f.read())
+            self.html = CompiledTemplate(f.read())
+
+        digest = hashlib.sha256()
+        for template in [self.sectionNote, self.inlineNote, self.endNote, self.headNote, self.html]:
+            digest.update(template.template.encode('utf-8'))
+            digest.update(b"\0")
+        self.digest = digest.hexdigest()
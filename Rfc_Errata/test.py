@@ -2,14 +2,27 @@ import pycodestyle
 # import platform
 import unittest
 import os
-# import shutil
+import shutil
 import sys
 import subprocess
+import contextlib
 import difflib
+import gzip
+import io
 import json
-from Rfc_Errata.template import Templates
-
-from Rfc_Errata.apply_errata import apply_errata
+import pickle
+import threading
+import re
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from Rfc_Errata.template import Templates, CompiledTemplate
+
+from Rfc_Errata.apply_errata import apply_errata, compilePattern, normaliseErrata, Erratum
+from Rfc_Errata.matching import SectionIndex, firstMatches, matchKey, editScan, fuzzyFind
+from Rfc_Errata.utils import strip_pagebreaks, stream_pagebreaks, LineBuffer, LineRange, join_lines
+from Rfc_Errata import checker as checkerModule
+from Rfc_Errata.checker import checker
 from optparse import Values
 
 test_program = "rfc-errata"
@@ -35,13 +48,13 @@ class Test_Coding(unittest.TestCase):
     def test_pycodestyle_conformance(self):
         """Test that we conform to PEP8."""
         pep8style = pycodestyle.StyleGuide(quiet=False, config_file="pycode.cfg")
-        result = pep8style.check_files(['run.py', 'apply_errata.py', 'checker.py',
+        result = pep8style.check_files(['run.py', 'apply_errata.py', 'checker.py', 'benchmark.py', 'matching.py',
                                         'template.py', 'test.py', 'utils.py'])
         self.assertEqual(result.total_errors, 0,
                          "Found code style errors (and warnings).")
 
     def test_pyflakes_confrmance(self):
-        p = subprocess.Popen(['pyflakes', 'run.py', 'apply_errata.py', 'checker.py',
+        p = subprocess.Popen(['pyflakes', 'run.py', 'apply_errata.py', 'checker.py', 'benchmark.py', 'matching.py',
                               'template.py', 'test.py', 'utils.py'],
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         (stdoutX, stderrX) = p.communicate()
@@ -62,6 +75,23 @@ class TestCommandLineOptions(unittest.TestCase):
                       None, None)
 
 
+class TestStrip(unittest.TestCase):
+    """ The streaming page stripper must agree with the whole text one """
+    def test_stream(self):
+        for name in ["RFC793", "RFC822", "RFC854", "RFC1122", "RFC1322", "RFC4543", "RFC8275"]:
+            with open("Tests/{0}.txt".format(name), encoding='iso-8859-1') as f:
+                text = f.read()
+            with open("Tests/{0}.txt".format(name), encoding='iso-8859-1') as f:
+                lines = list(stream_pagebreaks(f))
+            expected = "\n".join([x.txt for x in strip_pagebreaks(text)[0]]).splitlines(True)
+            self.assertEqual(lines, expected, name)
+
+    def test_stream_pages(self):
+        for text in ["", "one line", "one\ntwo\n\n", "split\fmid line\n", "\f\f", "a\nb\f\nc\x0bd\n\f"]:
+            expected = "\n".join([x.txt for x in strip_pagebreaks(text)[0]]).splitlines(True)
+            self.assertEqual(list(stream_pagebreaks(io.StringIO(text))), expected, repr(text))
+
+
 class TestSection(unittest.TestCase):
     """ Run a set of sectioning tests to make sure nothing changes """
     # Other files 2648, 3447, 4207, 5570, 7530, 8095, 8095
@@ -86,6 +116,24 @@ class TestSection(unittest.TestCase):
         postDoc = "".join(doc.source,)
         self.assertEqual(preDoc, postDoc)
 
+    def test_line_buffer(self):
+        lines = ["a\n", "bb\n", "\n", "ccc"]
+        buffer = LineBuffer(lines)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(list(buffer), lines)
+        self.assertEqual(buffer[1], "bb\n")
+        self.assertEqual(buffer[-1], "ccc")
+        self.assertEqual(buffer[1:3], lines[1:3])
+        self.assertEqual(buffer.join(1, 4), "bb\n\nccc")
+
+        section = LineRange(buffer, 1, 3)
+        self.assertEqual(len(section), 2)
+        self.assertEqual(list(section), lines[1:3])
+        self.assertEqual(section[:1] + ["x\n"] + section[1:], ["bb\n", "x\n", "\n"])
+        self.assertEqual(join_lines(section), "bb\n\n")
+        with self.assertRaises(IndexError):
+            section[2]
+
     def test_section_RFC822(self):
         errata = [{"doc-id": "RFC0822"}]
         doc = apply_errata(errata, None, None)
@@ -340,6 +388,123 @@ class TestInline(unittest.TestCase):
 
         self.assertTrue(compare_file("./Temp/RFC8275.html", "./Results/inline-seven.html", True))
 
+    def test_prefix_ids(self):
+        # One errata id being a prefix of another must not confuse the placement
+        with open("Tests/inline-two.json") as f:
+            errata = json.load(f)
+        errata[0]["errata_id"] = 5
+        errata[1]["errata_id"] = 51
+        if not os.path.exists("Temp"):
+            os.mkdir("Temp")
+        state = {"text": "./Tests", "html": "./Temp", "ossPath": "css"}
+        options = Values(defaults={'search': False})
+
+        doc = apply_errata(errata, options, state)
+
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+
+        doc.apply(True, templates)
+
+        self.assertEqual(doc.InlineCount, 2)
+        with open("./Temp/RFC8275.html", encoding='utf-8') as f:
+            text = f.read()
+        for errataId in ["5", "51"]:
+            self.assertEqual(text.count("<button id=\"btn_{0}\"".format(errataId)), 1)
+            self.assertEqual(text.count("id='expand_{0}'>".format(errataId)), 1)
+            self.assertEqual(text.count("id__locate={0}>".format(errataId)), 1)
+        self.assertIn("Section 6.4.1.1.9 of [RFC753A]</span id__locate=5>", text)
+        self.assertIn("Section 55.4 of [SUSv4]</span id__locate=51>", text)
+        self.assertIn("<a href='#btn_5'>EID 5</a>", text)
+        self.assertIn("<a href='#btn_51'>EID 51</a>", text)
+
+    def test_header_order(self):
+        # The header lists the errata by number, not as text
+        with open("Tests/inline-two.json") as f:
+            errata = json.load(f)
+        errata[0]["errata_id"] = 10
+        errata[1]["errata_id"] = 9
+        if not os.path.exists("Temp"):
+            os.mkdir("Temp")
+        state = {"text": "./Tests", "html": "./Temp", "ossPath": "css"}
+        options = Values(defaults={'search': False})
+
+        doc = apply_errata(errata, options, state)
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+        doc.apply(True, templates)
+
+        with open("./Temp/RFC8275.html", encoding='utf-8') as f:
+            text = f.read()
+        self.assertLess(text.index("EID 9</a>"), text.index("EID 10</a>"))
+
+    def test_fuzzy(self):
+        # A misspelt and reflowed quote is only placed inline when asked for
+        if not os.path.exists("Temp"):
+            os.mkdir("Temp")
+        state = {"text": "./Tests", "html": "./Temp", "ossPath": "css"}
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+
+        for fuzzy, inline in [(False, 0), (True, 1)]:
+            with open("Tests/inline-one.json") as f:
+                errata = json.load(f)
+            errata[0]["orig_text"] = "When applying the mode, Section 6.4.1.1 of\n[RFC7530] recomends that servers"
+            errata[0]["correct_text"] = "When applying the mode, Section 6.4.1.1.9 of [RFC753A] recommends that servers"
+            options = Values(defaults={'search': False, 'fuzzy': fuzzy})
+
+            doc = apply_errata(errata, options, state)
+            doc.apply(True, templates)
+
+            self.assertEqual(doc.InlineCount, inline)
+            self.assertEqual(doc.SectionCount, 1 - inline)
+
+        with open("./Temp/RFC8275.html", encoding='utf-8') as f:
+            text = f.read()
+        self.assertIn("<span class=\"Verified-inline-styling\" id='inline-1'>When applying the mode, " +
+                      "Section 6.4.1.1.9 of [RFC753A] recommends that servers</span id__locate=1>", text)
+
+
+class TestTemplate(unittest.TestCase):
+    def test_compiled(self):
+        fields = {"errata_id": 5, "notes": "a $b", "HEADER": "<h>"}
+        for text in ["$errata_id: ${notes}$$ and $$notes", "", "${HEADER}${errata_id}", "$missing", "a $ b\n$"]:
+            try:
+                expected = Template(text).substitute(fields, notes="n")
+            except (KeyError, ValueError) as e:
+                with self.assertRaises(type(e)) as cm:
+                    CompiledTemplate(text).substitute(fields, notes="n")
+                self.assertEqual(str(cm.exception), str(e))
+                continue
+            self.assertEqual(CompiledTemplate(text).substitute(fields, notes="n"), expected)
+            f = io.StringIO()
+            CompiledTemplate(text).write(f, fields, notes="n")
+            self.assertEqual(f.getvalue(), expected)
+
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+        fields = {"status_tag": "Verified", "errata_list": "<a href='#eid5'>EID 5</a>"}
+        self.assertEqual(templates.headNote.substitute(fields), Template(templates.headNote.template).substitute(fields))
+
+    def test_stream(self):
+        f = io.StringIO()
+        CompiledTemplate("<b>$BODY</b>$n").write(f, {"BODY": iter(["a\n", "b\n"]), "n": 1})
+        self.assertEqual(f.getvalue(), "<b>a\nb\n</b>1")
+
+
+class TestErratum(unittest.TestCase):
+    def test_record(self):
+        fields = {"errata_id": 7, "doc-id": "RFC8275", "status_tag": "Verified", "custom": "x"}
+        item = Erratum(fields)
+        self.assertEqual(item.asDict(), fields)
+        self.assertEqual(item["doc-id"], "RFC8275")
+        self.assertEqual(item["custom"], "x")
+        self.assertNotIn("orig_text2", item)
+        self.assertIsNone(item.get("orig_text2"))
+        with self.assertRaises(KeyError):
+            item["notes"]
+
+        item["orig_text2"] = "text"
+        self.assertIn("orig_text2", item)
+        self.assertIs(Erratum({"status_tag": "".join(["Veri", "fied"])})["status_tag"], item["status_tag"])
+        self.assertEqual(pickle.loads(pickle.dumps(item)).asDict(), item.asDict())
+
 
 class TestSectionNote(unittest.TestCase):
     def test_one(self):
@@ -464,6 +629,56 @@ class TestSearch(unittest.TestCase):
 
         self.assertTrue(compare_file("./Temp/RFC8275.html", "./Results/search2.html", True))
 
+    def test_index(self):
+        index = SectionIndex({"1": "The quick brown fox\njumps over",
+                              "2": "the lazy dog and the quick\n   brown cat",
+                              "3": "brown bread"})
+        self.assertEqual(list(index.sections(index.lookup("quick brown fox"))), ["1", "2", "3"])
+        self.assertEqual(list(index.sections(index.lookup("The quick brown cat"))), ["1", "2"])
+        self.assertEqual(list(index.sections(index.lookup("lazy dog and the"))), ["2"])
+        self.assertEqual(list(index.sections(index.lookup("fox jumps over the lazy"))), [])
+
+    def test_first_matches(self):
+        texts = {"1": "The quick brown fox\njumps over\n   the  lazy dog, the quick\tbrown cat",
+                 "2": "    she sells   sea shells\n    by the sea shore"}
+        wanted = {"1": ["quick brown", "the lazy dog", "brown cat", "lazy cat", ""],
+                  "2": ["sea", "sea shells by", "sells sea shells by the sea shore"]}
+        found = firstMatches(texts, dict((name, set(matchKey(t) for t in keys)) for name, keys in wanted.items()),
+                             compilePattern)
+        for name, keys in wanted.items():
+            for key in keys:
+                match = re.search(r"\s+".join(re.escape(word) for word in key.split()), texts[name])
+                if match:
+                    self.assertEqual(found[(name, key)], match.span())
+                else:
+                    self.assertNotIn((name, key), found)
+
+    def test_fuzzy_find(self):
+        # An anchored scan has to start at the beginning of the text
+        self.assertEqual(editScan("abc", "xabc", float("inf")), (0, 4))
+        self.assertEqual(editScan("abc", "xabc", float("inf"), True), (1, 4))
+
+        # Two near copies that overlap, the span reported is the one scored
+        text = "she sells sea shells by the sea sells sea shells by the sea shor, she said"
+        start, end, confidence = fuzzyFind("sells sea shells by the sea shore", text, 0.8, 1)
+        self.assertEqual(text[start:end], "sells sea shells by the sea shor")
+        self.assertEqual(confidence, 1 - 1 / 33)
+
+        text = "the cat sat on the mat\n   the cat sat on  the hat"
+        start, end, confidence = fuzzyFind("cat sat on the rat", text, 0.8, 1)
+        self.assertEqual((start, end), (4, 22))
+
+    def test_pattern_cache(self):
+        pattern = compilePattern("The  quick\n brown fox")
+        self.assertIs(compilePattern("The  quick\n brown fox"), pattern)
+        self.assertTrue(pattern.search("the The quick brown fox"))
+
+        texts = normaliseErrata("| The quick\n| brown fox", None)
+        self.assertEqual(texts, (" The quick\n brown fox", None))
+        hits = normaliseErrata.cache_info().hits
+        self.assertIs(normaliseErrata("| The quick\n| brown fox", None), texts)
+        self.assertEqual(normaliseErrata.cache_info().hits, hits + 1)
+
 
 class TestHtmlQuoting(unittest.TestCase):
     def test_errata(self):
@@ -487,6 +702,412 @@ class TestHtmlQuoting(unittest.TestCase):
         self.assertTrue(compare_file("./Temp/RFC8275.html", "./Results/quote1.html", True))
 
 
+class TestRenderCache(unittest.TestCase):
+    def render(self, state):
+        with open("Tests/inline-one.json") as f:
+            errata = json.load(f)
+        options = Values(defaults={'search': False})
+        doc = apply_errata(errata, options, state)
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+        doc.apply(False, templates)
+        return doc.InlineCount
+
+    def test_skip(self):
+        if os.path.exists("Temp/cache"):
+            shutil.rmtree("Temp/cache")
+        os.makedirs("Temp/cache")
+        state = {"text": "./Tests", "html": "./Temp/cache", "ossPath": "css"}
+
+        self.assertEqual(self.render(state), 1)
+        self.assertEqual(self.render(state), 0)
+        self.assertTrue(compare_file("./Temp/cache/RFC8275.html", "./Results/inline-one.html", True))
+
+        state["ossPath"] = "css2"
+        self.assertEqual(self.render(state), 1)
+        self.assertEqual(self.render(state), 0)
+
+        os.remove("Temp/cache/RFC8275.key")
+        self.assertEqual(self.render(state), 1)
+
+
+class TestPreprocessed(unittest.TestCase):
+    def render(self, state, loadDocument=True):
+        with open("Tests/inline-two.json") as f:
+            errata = json.load(f)
+        options = Values(defaults={'search': False})
+        doc = apply_errata(errata, options, state)
+        if not loadDocument:
+            doc.loadDocument = None
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+        doc.apply(True, templates)
+        return doc
+
+    def test_cache(self):
+        if os.path.exists("Temp/pre"):
+            shutil.rmtree("Temp/pre")
+        os.makedirs("Temp/pre")
+        state = {"text": "./Tests", "html": "./Temp", "ossPath": "css", "cache": "./Temp/pre"}
+
+        first = self.render(state)
+        self.assertTrue(os.path.exists("Temp/pre/RFC8275.pre"))
+
+        # The second run must not go back to the text
+        second = self.render(state, False)
+        self.assertEqual(second.allSections, first.allSections)
+        self.assertEqual(second.InlineCount, 2)
+        self.assertTrue(compare_file("./Temp/RFC8275.html", "./Results/inline-two.html", True))
+
+        with open("Temp/pre/RFC8275.pre", "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(self.render(state).InlineCount, 2)
+
+
+@contextlib.contextmanager
+def inDirectory(path):
+    "Run the body of the with statement in path, which is made if needed"
+    if not os.path.exists(path):
+        os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+@contextlib.contextmanager
+def httpServer(handler):
+    "Serve handler on a local port and yield the host:port to connect to"
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield "127.0.0.1:{0}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def checkerSetup(jobs):
+    # Two copies of RFC 8275 with one erratum each, so there is something
+    # for each worker to do
+
+    if os.path.exists("Temp/checker"):
+        shutil.rmtree("Temp/checker")
+    os.makedirs("Temp/checker/text")
+    os.makedirs("Temp/checker/html")
+
+    with open("Tests/RFC8275.txt", "rb") as f:
+        text = f.read()
+
+    errata = []
+    for rfc, name in [("RFC8275", "inline-one"), ("RFC8276", "section1")]:
+        with open("Tests/{0}.json".format(name)) as f:
+            items = json.load(f)
+        for item in items:
+            item["doc-id"] = rfc
+            item["errata_status_code"] = "Verified"
+        errata.extend(items)
+        with open("Temp/checker/text/{0}.txt".format(rfc.lower()), "wb") as f:
+            f.write(text)
+
+    state = {"text": "./Temp/checker/text", "html": "./Temp/checker/html", "ossPath": "css",
+             "which": ["Verified", "Held"]}
+    options = Values(defaults={'search': False, 'verbose': False, 'force': False, 'jobs': jobs})
+    return errata, options, state
+
+
+def checkerRun(errata, options, state):
+    templates = Templates(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Template"))
+    check = checker(options, state)
+    check.errata = json.loads(json.dumps(errata))
+    check.filterErrata()
+    errorCount = check.processAllRfcs(templates)
+    return errorCount, (check.inlineCount, check.sectionCount, check.endnoteCount)
+
+
+class TestChecker(unittest.TestCase):
+    def test_jobs(self):
+        errata, options, state = checkerSetup(2)
+        self.assertEqual(checkerRun(errata, options, state), (0, (1, 1, 0)))
+        self.assertTrue(os.path.exists("./Temp/checker/html/rfc8275.html"))
+        self.assertTrue(os.path.exists("./Temp/checker/html/rfc8276.html"))
+
+    def test_changes(self):
+        errata, options, state = checkerSetup(1)
+        self.assertEqual(checkerRun(errata, options, state), (0, (1, 1, 0)))
+
+        # Nothing changed
+        self.assertEqual(checkerRun(errata, options, state), (0, (0, 0, 0)))
+
+        # An edited erratum
+        errata[1]["notes"] = "Changed notes"
+        self.assertEqual(checkerRun(errata, options, state), (0, (0, 1, 0)))
+
+        # A status change removes the only erratum of RFC 8275
+        errata[0]["errata_status_code"] = "Rejected"
+
+        # but not when more RFCs lose their errata at once than allowed
+        options.max_removals = 0
+        guarded = dict(state, text=os.path.abspath(state["text"]), html=os.path.abspath(state["html"]))
+        with inDirectory("Temp/checker"), contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(checkerRun(errata, options, guarded), (1, (0, 0, 0)))
+        self.assertTrue(os.path.exists("Temp/checker/errors.log"))
+        self.assertTrue(os.path.exists("Temp/checker/html/rfc8275.html"))
+        with open("Temp/checker/html/manifest.json") as f:
+            self.assertEqual(sorted(json.load(f)["rfcs"]), ["rfc8275", "rfc8276"])
+
+        options.max_removals = 1
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(checkerRun(errata, options, state), (0, (0, 0, 0)))
+        self.assertEqual(stdout.getvalue(), "Removing the page of rfc8275, which no longer has any errata\n")
+        self.assertFalse(os.path.exists("Temp/checker/html/rfc8275.html"))
+        self.assertFalse(os.path.exists("Temp/checker/html/rfc8275.key"))
+        with open("Temp/checker/html/manifest.json") as f:
+            self.assertEqual(list(json.load(f)["rfcs"]), ["rfc8276"])
+
+        # A lost html file
+        os.remove("Temp/checker/html/rfc8276.html")
+        self.assertEqual(checkerRun(errata, options, state), (0, (0, 1, 0)))
+
+        # A new css path invalidates the manifest, and every page is rendered again
+        state["ossPath"] = "css2"
+        self.assertEqual(checkerRun(errata, options, state), (0, (0, 1, 0)))
+        self.assertEqual(checkerRun(errata, options, state), (0, (0, 0, 0)))
+
+    def test_prefetch(self):
+        with open("Tests/RFC8275.txt", "rb") as f:
+            text = f.read()
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requests.append(self.path)
+                if len(requests) == 1:
+                    self.send_response(503)
+                    body = b""
+                elif self.path in ["/rfc/rfc8275.txt", "/rfc/rfc793.txt"]:
+                    self.send_response(200)
+                    body = text
+                else:
+                    self.send_response(404)
+                    body = b""
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        # Failed downloads are logged to errors.log in the current directory
+        with inDirectory("Temp/fetch"), httpServer(Handler) as serverName:
+            for name in ["RFC8275", "RFC793", "RFC1"]:
+                if os.path.exists("{0}.txt".format(name)):
+                    os.remove("{0}.txt".format(name))
+
+            state = {"text": ".", "serverName": serverName}
+            options = Values(defaults={'verbose': False, 'fetch_jobs': 2})
+            check = checker(options, state)
+            check.connectionClass = HTTPConnection
+            check.fetchBackoff = 0
+
+            errorCount = check.prefetchTexts(["RFC8275", "RFC793", "RFC1"])
+
+            # A text that cannot be written is not downloaded again
+            state["text"] = "missing"
+            try:
+                with self.assertRaises(OSError):
+                    check.downloadText("RFC8275")
+            finally:
+                check.closeConnections()
+
+        self.assertEqual(errorCount, 1)
+        self.assertEqual(len(requests), 5)
+        self.assertEqual(check.fetchFailed, set(["RFC1"]))
+        for name in ["RFC8275", "RFC793"]:
+            with open("Temp/fetch/{0}.txt".format(name), "rb") as f:
+                self.assertEqual(f.read(), text)
+        self.assertFalse(os.path.exists("Temp/fetch/RFC1.txt"))
+
+    def test_worker_fetch_failed(self):
+        # A worker does not ask again for a text the parent failed to fetch
+        errata, options, state = checkerSetup(2)
+        os.remove("Temp/checker/text/rfc8276.txt")
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        check = checker(options, state)
+        check.errata = errata
+        check.filterErrata()
+        templates = Templates(os.path.join(os.path.dirname(__file__), "Template"))
+        with inDirectory("Temp/checker"), httpServer(Handler) as serverName:
+            state["serverName"] = serverName
+            checkerModule.initWorker(options, state, templates, set(["rfc8276"]))
+            checkerModule.workerChecker.connectionClass = HTTPConnection
+            result = checkerModule.processWorker(("rfc8276", check.byRfc["rfc8276"]))
+
+        self.assertEqual(result, (1, 0, 0, 0))
+        self.assertEqual(requests, [])
+
+    def test_save_errata(self):
+        body = b'[{"errata_id": 1, "notes": "one\\r\\ntwo\\r\\nthree"}]'
+        chunkSize = checkerModule.ChunkSize
+        try:
+            with inDirectory("Temp"):
+                for size in range(1, 8):
+                    checkerModule.ChunkSize = size
+                    check = checker(None, None)
+                    data = check.saveErrataFile(io.BytesIO(body))
+                    self.assertEqual(data, [{"errata_id": 1, "notes": "one\ntwo\nthree"}])
+                    with open("errata.json", "rb") as f:
+                        self.assertEqual(f.read(), body.replace(b"\\r\\n", b"\\n"))
+                    self.assertFalse(os.path.exists("errata.json.tmp"))
+
+                with self.assertRaises(ValueError):
+                    check.saveErrataFile(io.BytesIO(b'[{"errata_id": '))
+                self.assertFalse(os.path.exists("errata.json.tmp"))
+                with open("errata.json", "rb") as f:
+                    self.assertEqual(f.read(), body.replace(b"\\r\\n", b"\\n"))
+        finally:
+            checkerModule.ChunkSize = chunkSize
+
+    def test_index(self):
+        errata = [{"errata_id": 1, "doc-id": "RFC0793", "notes": "caf\u00e9"},
+                  {"errata_id": 2, "doc-id": "RFC8275", "notes": "\u2019"},
+                  {"errata_id": 3, "doc-id": "RFC793", "notes": "n"}]
+        body = json.dumps(errata, indent=4, ensure_ascii=False).encode('utf-8')
+        data, index = checkerModule.parseErrata(body)
+        self.assertEqual(data, errata)
+        self.assertEqual(sorted(index), ["rfc793", "rfc8275"])
+        self.assertEqual([json.loads(body[start:end].decode('utf-8')) for start, end in index["rfc793"]],
+                         [errata[0], errata[2]])
+
+        # The same errata and index come from a body split at any point
+        for size in [1, 2, 3, 7, 64]:
+            parser = checkerModule.errataParser()
+            for start in range(0, len(body), size):
+                parser.feed(body[start:start+size])
+            parser.feed(b"", True)
+            self.assertEqual((parser.errata, parser.index), (data, index))
+
+        with inDirectory("Temp/index"):
+            check = checker(Values(defaults={'no_network': True}), None)
+            check.saveErrataFile(io.BytesIO(body))
+
+            check = checker(Values(defaults={'no_network': True}), None)
+            check.loadErrata(["rfc8275", "rfc1"])
+            self.assertEqual(check.errata, [errata[1]])
+
+            # A changed errata.json makes the index stale
+            with open("errata.json", "wb") as f:
+                f.write(body + b"\n")
+            self.assertIsNone(check.readIndex())
+            check = checker(Values(defaults={'no_network': True}), None)
+            check.loadErrata(["rfc8275"])
+            self.assertEqual(check.errata, errata)
+            self.assertIsNotNone(check.readIndex())
+
+    def test_snapshot(self):
+        errata = [{"errata_id": 1, "doc-id": "RFC0793", "section": "1", "errata_status_code": "Verified"},
+                  {"errata_id": 2, "doc-id": "RFC8275", "section": "2",
+                   "errata_status_code": "Held for Document Update"}]
+        parseErrata = checkerModule.parseErrata
+        try:
+            with inDirectory("Temp/snapshot"):
+                for name in ["errata.idx", "errata.snapshot"]:
+                    if os.path.exists(name):
+                        os.remove(name)
+                options = Values(defaults={'no_network': True})
+                state = {"which": ["Verified", "Held"]}
+                check = checker(options, state)
+                check.errata = check.saveErrataFile(io.BytesIO(json.dumps(errata).encode('utf-8')))
+                check.filterErrata()
+                self.assertTrue(os.path.exists("errata.snapshot"))
+
+                # An unchanged errata.json is not parsed again
+                def failParse(data):
+                    raise AssertionError("errata.json parsed")
+                checkerModule.parseErrata = failParse
+                check = checker(options, state)
+                check.loadErrata()
+                check.filterErrata()
+                self.assertEqual(sorted(check.byRfc), ["rfc793", "rfc8275"])
+                self.assertEqual(check.byRfc["rfc8275"][0]["status_tag"], "Held")
+                self.assertEqual(sorted(check.fingerprints["rfc793"]), ["1"])
+
+                # Another set of statuses is filtered again
+                checkerModule.parseErrata = parseErrata
+                check = checker(options, {"which": ["Verified"]})
+                check.loadErrata()
+                check.filterErrata()
+                self.assertEqual(sorted(check.byRfc), ["rfc793"])
+        finally:
+            checkerModule.parseErrata = parseErrata
+
+    def test_conditional_download(self):
+        body = b'[{"errata_id": 1, "notes": "one\\r\\ntwo"}]'
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requests.append(dict(self.headers))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = gzip.compress(body)
+                self.send_response(200)
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("ETag", '"v1"')
+                self.send_header("Last-Modified", "Tue, 01 Mar 2022 00:00:00 GMT")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        with inDirectory("Temp/download"), httpServer(Handler) as serverName:
+            if os.path.exists("errata.json"):
+                os.remove("errata.json")
+            state = {"serverName": serverName, "lastCheck": "Sun, 21 Apr 2019 00:00:00 GMT"}
+            options = Values(defaults={'verbose': False})
+
+            check = checker(options, state)
+            check.connectionClass = HTTPConnection
+            self.assertTrue(check.downloadErrataFile())
+            check.connection.close()
+            self.assertEqual(check.errata, [{"errata_id": 1, "notes": "one\ntwo"}])
+            self.assertEqual(state["etag"], '"v1"')
+            self.assertEqual(state["lastCheck"], "Tue, 01 Mar 2022 00:00:00 GMT")
+
+            check = checker(options, state)
+            check.connectionClass = HTTPConnection
+            self.assertFalse(check.downloadErrataFile())
+            check.connection.close()
+            self.assertIsNone(check.errata)
+
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0]["Accept-Encoding"], "gzip")
+        self.assertNotIn("If-None-Match", requests[0])
+        self.assertEqual(requests[1]["If-None-Match"], '"v1"')
+        self.assertEqual(requests[1]["If-Modified-Since"], "Tue, 01 Mar 2022 00:00:00 GMT")
+
+
 def compare_file2(errFile, stderr, displayError):
     with open(stderr, 'rb') as f:
         stderr = f.read()
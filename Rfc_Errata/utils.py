@@ -4,6 +4,9 @@
 from __future__ import print_function, unicode_literals, division
 
 import re
+import array
+import hashlib
+import itertools
 from collections import namedtuple
 
 try:
@@ -19,6 +22,140 @@ except ImportError:
 Line = namedtuple('Line', ['num', 'txt'])
 
 
+class Markup(str):
+    "Text that is already HTML, as opposed to plain text that still needs escaping"
+    __slots__ = ()
+
+
+class LineBuffer(object):
+    """The lines of a document held as one string and an array of line offsets.
+
+    Indexing gives a line and slicing a list of lines, so it reads like the
+    list of lines it replaces.
+    """
+
+    def __init__(self, lines=(), text=None, offsets=None):
+        if text is not None:
+            self.text = text
+            self.offsets = offsets
+            return
+
+        lines = list(lines)
+        self.offsets = array.array('L', [0])
+        pos = 0
+        for line in lines:
+            pos += len(line)
+            self.offsets.append(pos)
+        self.text = "".join(lines)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        return self.text[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.text[self.offsets[i]:self.offsets[i+1]]
+
+    def join(self, start, end):
+        "The text of lines start to end as one string"
+        return self.text[self.offsets[start]:self.offsets[end]]
+
+
+class LineRange(object):
+    "A run of lines of a LineBuffer, read like a list without copying the lines"
+    __slots__ = ("buffer", "start", "end")
+
+    def __init__(self, buffer, start, end):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        return self.buffer[self.start + i]
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.buffer[i]
+
+    def join(self):
+        return self.buffer.join(self.start, self.end)
+
+
+def join_lines(lines):
+    "Join a list of lines or a LineRange into one string"
+    if isinstance(lines, LineRange):
+        return lines.join()
+    return "".join(lines)
+
+
+# Page header and footer heuristics.  Every header pattern is anchored at the
+# start of the line, so they are combined into one alternation and tried with a
+# single match() in the original order of precedence.  The running title is
+# captured by the first alternative, a draft name footer by the last one.
+
+Months = "(?:Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)"
+Years = "(?:19[89][0-9]|20[0-9][0-9])"
+
+HeaderLate = [
+    r"(?:INTERNET.DRAFT|Internet.Draft|RFC \d+)  +(?P<title>\S.*\S)  +" + Months + r"[a-z]*(?: \d\d?,)? " + Years + " *$",
+    r".{58,}" + Months + "[a-z]+ " + Years + " *$",
+    r" *Internet.Draft.+[12][0-9][0-9][0-9] *$",
+    r" *(?:Internet.Draft|INTERNET.DRAFT) {16,}.*$",
+]
+HeaderAlways = [
+    r" *Draft.+[12][0-9][0-9][0-9] *$",
+    r"RFC[ -]?[0-9]+.* +[12][0-9][0-9][0-9]$",
+    r"(?P<end>draft-[-a-z0-9_.]+.*[0-9][0-9][0-9][0-9])$",
+]
+
+PageHeader = re.compile("|".join(HeaderLate + HeaderAlways), re.I)
+PageHeaderEarly = re.compile("|".join(HeaderAlways), re.I)
+PageDraftName = re.compile(r" *draft-[-a-z0-9_.]+ *$", re.I)
+PageFooter = re.compile(r"(  *)(\S.*\S)?(  +)\[?[Pp]age [0-9ivx]+\]?[ \t\f]*$", re.I)
+
+# A line matching this ends a paragraph, so it is not joined with the next page:
+# it ends with a period, starts with a section number, a list bullet, an
+# address component or a Table or Figure label.
+
+SentenceEnd = re.compile(r"[.:+]\)?$|^(?:[A-Z0-9][0-9]*\.| +[o*+-]  | +E[Mm]ail: | +(?:Table|Figure)(?: +\d+)?: )")
+LineStart = re.compile(r"[^ \t]")
+BlankLine = re.compile(r"[ \t]*$")
+
+
+def page_footer(line):
+    # The footer pattern backtracks badly on ordinary text, so check for the
+    # word first
+    if "age " not in line.lower():
+        return None
+    return PageFooter.search(line)
+
+
+def file_digest(fileName):
+    "Return the SHA-256 hex digest of a file, read in blocks"
+    digest = hashlib.sha256()
+    with open(fileName, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def strip_pagebreaks_old(text):
     "Strip ID/RFC-style headers and footers from the given text"
     short_title = None
@@ -51,7 +188,7 @@ def strip_pagebreaks_old(text):
 
     for lineno, line in enumerate(lines):
         line = line.rstrip()
-        match = re.search("(  *)(\S.*\S)?(  +)\[?[Pp]age [0-9ivx]+\]?[ \t\f]*$", line, re.I)
+        match = page_footer(line)
         if match:
             if match.start(2) != -1:
                 mid = match.group(2)
@@ -60,52 +197,29 @@ def strip_pagebreaks_old(text):
             page, newpage = endpage(page, newpage, line)
             continue
 
-        if re.search("\f", line, re.I):
+        if "\f" in line:
             page, newpage = begpage(page, newpage)
             continue
 
         if lineno > 25:
-            regex = "^(INTERNET.DRAFT|Internet.Draft|RFC \d+)(  +)(\S.*\S)(  +)(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]*( \d\d?,)? (19[89][0-9]|20[0-9][0-9]) *$"
-            match = re.search(regex, line, re.I)
-            if match:
-                short_title = match.group(3)
+            match = PageHeader.match(line)
+        else:
+            match = PageHeaderEarly.match(line)
+        if match:
+            if match.group("end") is not None:
+                page, newpage = endpage(page, newpage, line)
+            else:
+                if match.groupdict().get("title") is not None:
+                    short_title = match.group("title")
                 page, newpage = begpage(page, newpage, line)
-                continue
-
-        if lineno > 25 and re.search(".{58,}(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]+ (19[89][0-9]|20[0-9][0-9]) *$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
             continue
-
-        if lineno > 25 and re.search("^ *Internet.Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
-            continue
-        if lineno > 25 and re.search("^ *(Internet.Draft|INTERNET.DRAFT)( {16,}).*$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
-            continue
-#        if re.search("^ *Internet.Draft  +", line, re.I):
-#            newpage = True
-#            continue
-        if re.search("^ *Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
+        if newpage and PageDraftName.match(line):
             page, newpage = begpage(page, newpage, line)
             continue
 
-        if re.search("^RFC[ -]?[0-9]+.*( +)[12][0-9][0-9][0-9]$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
-            continue
-        if re.search("^RFC[ -]?[0-9]+.*(  +)[12][0-9][0-9][0-9]$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
-            continue
-
-        if re.search("^draft-[-a-z0-9_.]+.*[0-9][0-9][0-9][0-9]$", line, re.I):
-            page, newpage = endpage(page, newpage, line)
-            continue
-        if newpage and re.search("^ *draft-[-a-z0-9_.]+ *$", line, re.I):
-            page, newpage = begpage(page, newpage, line)
-            continue
-
-        if re.search("^[^ \t]+", line):
+        if LineStart.match(line):
             sentence = True
-        if re.search("[^ \t]", line):
+        if LineStart.search(line):
             if newpage:
                 if sentence:
                     stripped += [Line(lineno-1, "")]
@@ -116,17 +230,7 @@ def strip_pagebreaks_old(text):
             sentence = False
             newpage = False
 
-        if re.search("[.:+]\)?$", line):    # line ends with a period; don't join with next page para
-            sentence = True
-        if re.search("^[A-Z0-9][0-9]*\.", line):  # line starts with a section number; don't join with next page para
-            sentence = True
-
-        if re.search("^ +[o*+-]  ", line):  # line starts with a list bullet; don't join with next page para
-            sentence = True
-        if re.search("^ +(E[Mm]ail): ", line):  # line starts with an address component; don't join with next page para
-            sentence = True
-
-        if re.search("^ +(Table|Figure)( +\d+)?: ", line):  # line starts with Table or Figure label; don't join with next page para
+        if SentenceEnd.search(line):
             sentence = True
 
         if line.strip() and len(line) < 50:              # line is too short; don't join with next page para
@@ -135,7 +239,7 @@ def strip_pagebreaks_old(text):
         if line.rstrip() and line.rstrip()[-1] == ',':
             sentence = False
 
-        if re.search("^[ \t]*$", line):
+        if BlankLine.match(line):
             blankcount += 1
             if blankcount > 7:
                 sentence = True
@@ -149,116 +253,127 @@ def strip_pagebreaks_old(text):
     return stripped, short_title
 
 
-def strip_pagebreaks(text):
-    "Strip ID/RFC-style headers and footers from the given text"
+def strip_page(page, firstLine):
+    "Strip the header and footer from the lines of one page"
     short_title = None
-    stripped = []
-    page = []
-    line = ""
-    newpage = False
-    sentence = False
 
-    # break it into the page units we are going to play with
+    lines = []
+    for lineno, line in enumerate(page):
+        lines += [Line(lineno + firstLine, line.rstrip())]
+    lines += [Line(len(lines)+firstLine, "")]
 
-    pages = text.split('\f')
-    if len(pages) < 2:
-        return strip_pagebreaks_old(text)
+    # Strip down from top of page
 
-    lastLine = 0
-    for page in pages:
-        firstLine = lastLine
-        lines = []
+    for i in range(len(lines)):
+        line = lines[i].txt
 
-        for lineno, line in enumerate(page.splitlines()):
-            lines += [Line(lineno + firstLine, line.rstrip())]
-        lines += [Line(len(lines)+firstLine, "")]
+        if len(line) == 0:
+            continue
+
+        #  Top of page lines
+
+        if firstLine > 0:
+            match = PageHeader.match(line)
+            if match:
+                if match.group("title") is not None:
+                    short_title = match.group("title")
+                continue
 
-        lastLine = firstLine + len(lines)
+        break
 
-        # Strip down from top of page
-        if len(lines) == 0:
+    j = len(lines)-1
+    count = 0
+    for j in range(len(lines)-1, 0, -1):
+        line = lines[j].txt
+        if len(line) == 0:
+            count += 1
             continue
 
-        for i in range(len(lines)):
-            line = lines[i].txt
+        if page_footer(line):
+            continue
 
-            if len(line) == 0:
-                continue
+        break
 
-            #  Top of page lines
+    #  See if we think tht the last line is the end of paragraph
 
-            if firstLine > 0:
-                regex = "^(INTERNET.DRAFT|Internet.Draft|RFC \d+)(  +)(\S.*\S)(  +)(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]*( \d\d?,)? (19[89][0-9]|20[0-9][0-9]) *$"
-                match = re.search(regex, line, re.I)
-                if match:
-                    short_title = match.group(3)
-                    continue
+    sentence = 0
+    if count > 3:
+        sentence = True
+    elif SentenceEnd.search(line):
+        sentence = True
+    elif line.strip() and len(line) < 50:              # line is too short; don't join with next page para
+        sentence = True
 
-                if re.search(".{58,}(Jan|Feb|Mar|March|Apr|April|May|Jun|June|Jul|July|Aug|Sep|Oct|Nov|Dec)[a-z]+ (19[89][0-9]|20[0-9][0-9]) *$", line, re.I):
-                    continue
+    if line.rstrip() and line.rstrip()[-1] == ',':
+        sentence = False
 
-                if re.search("^ *Internet.Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
-                    continue
+    if sentence:
+        j += 1
 
-                if re.search("^ *(Internet.Draft|INTERNET.DRAFT)( {16,}).*$", line, re.I):
-                    continue
+    return lines[i:j+1], len(lines), short_title
 
-                if re.search("^ *Draft.+[12][0-9][0-9][0-9] *$", line, re.I):
-                    continue
 
-                if re.search("^RFC[ -]?[0-9]+.*( +)[12][0-9][0-9][0-9]$", line, re.I):
-                    continue
-                if re.search("^RFC[ -]?[0-9]+.*(  +)[12][0-9][0-9][0-9]$", line, re.I):
-                    continue
+def strip_pagebreaks(text):
+    "Strip ID/RFC-style headers and footers from the given text"
+    short_title = None
+    stripped = []
 
-                if re.search("^draft-[-a-z0-9_.]+.*[0-9][0-9][0-9][0-9]$", line, re.I):
-                    continue
-                if newpage and re.search("^ *draft-[-a-z0-9_.]+ *$", line, re.I):
-                    continue
+    # break it into the page units we are going to play with
 
-            break
+    pages = text.split('\f')
+    if len(pages) < 2:
+        return strip_pagebreaks_old(text)
 
-        j = len(lines)-1
-        count = 0
-        for j in range(len(lines)-1, 0, -1):
-            line = lines[j].txt
-            if len(line) == 0:
-                count += 1
-                continue
+    firstLine = 0
+    for page in pages:
+        lines, count, title = strip_page(page.splitlines(), firstLine)
+        firstLine += count
+        if title is not None:
+            short_title = title
+        stripped.extend(lines)
 
-            match = re.search("(  *)(\S.*\S)?(  +)\[?[Pp]age [0-9ivx]+\]?[ \t\f]*$", line, re.I)
-            if match:
-                continue
+    return stripped, short_title
 
-            break
 
-        #  See if we think tht the last line is the end of paragraph
+def read_pages(f):
+    "Split a file object into pages at form feeds, yielding the lines of each page"
+    page = []
+    for line in f:
+        pieces = line.split('\f')
+        page.extend(pieces[0].splitlines())
+        for piece in pieces[1:]:
+            yield page
+            page = piece.splitlines()
+    yield page
 
-        sentence = 0
-        if count > 3:
-            sentence = True
-        elif re.search("[.:+]\)?$", line):    # line ends with a period; don't join with next page para
-            sentence = True
-        elif re.search("^[A-Z0-9][0-9]*\.", line):  # line starts with a section number; don't join with next page para
-            sentence = True
 
-        elif re.search("^ +[o*+-]  ", line):  # line starts with a list bullet; don't join with next page para
-            sentence = True
-        elif re.search("^ +(E[Mm]ail): ", line):  # line starts with an address component; don't join with next page para
-            sentence = True
+def stripped_lines(pages):
+    firstLine = 0
+    for page in pages:
+        lines, count, title = strip_page(page, firstLine)
+        firstLine += count
+        yield from lines
 
-        elif re.search("^ +(Table|Figure)( +\d+)?: ", line):  # line starts with Table or Figure label; don't join with next page para
-            sentence = True
 
-        elif line.strip() and len(line) < 50:              # line is too short; don't join with next page para
-            sentence = True
+def stream_pagebreaks(f):
+    "Strip ID/RFC-style headers and footers from a file object, yielding the lines kept"
 
-        if line.rstrip() and line.rstrip()[-1] == ',':
-            sentence = False
+    # Pages are read lazily.  The lines come out as "\\n".join(...).splitlines(True)
+    # would give them for the result of strip_pagebreaks on the whole text.
 
-        if sentence:
-            j += 1
+    pages = read_pages(f)
+    first = next(pages)
+    second = next(pages, None)
 
-        stripped.extend(lines[i:j+1])
+    if second is None:
+        lines = strip_pagebreaks_old("\n".join(first))[0]
+    else:
+        lines = stripped_lines(itertools.chain([first, second], pages))
 
-    return stripped, short_title
+    last = None
+    for line in lines:
+        if last is not None:
+            yield last.txt + "\n"
+        last = line
+    if last is not None and last.txt:
+        yield last.txt